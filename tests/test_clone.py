@@ -0,0 +1,38 @@
+import unittest
+
+import zstory
+
+class CloneMemTest(unittest.TestCase):
+    def setUp(self):
+        self.env = zstory.make_env('\xba') # quit
+
+    def test_shared_until_written(self):
+        env = self.env
+        clone = env.clone()
+        self.assertIs(clone.mem, env.mem)
+        clone.write8(0x800, 1)
+        self.assertIsNot(clone.mem, env.mem)
+        self.assertEqual(env.mem[0x800], 0)
+        env.write16(0x800, 0x203) # the last one on it keeps it
+        self.assertIsNone(env.mem_share)
+        self.assertEqual(clone.mem[0x800], 1)
+
+    def test_clone_of_clone(self):
+        env = self.env
+        a = env.clone()
+        b = a.clone()
+        self.assertIs(b.mem, env.mem)
+        env.write8(0x900, 7)
+        self.assertIs(a.mem, b.mem)
+        b.write8(0x900, 8)
+        self.assertEqual((env.mem[0x900], a.mem[0x900], b.mem[0x900]), (7, 0, 8))
+
+    def test_reset(self):
+        env = self.env
+        env.write8(0x800, 5)
+        clone = env.clone()
+        clone.reset()
+        self.assertEqual((env.mem[0x800], clone.mem[0x800]), (5, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,24 @@
+import unittest
+
+import zstory
+
+# code in dyn mem that the game keeps rewriting: each write throws the
+# inst out, and each lookup decodes and keeps it again
+class RedecodeTest(unittest.TestCase):
+    def redecode(self, limit):
+        env = zstory.make_env('')
+        env.icache.limit = limit
+        for i in xrange(100):
+            env.write8(0x800, 0xba) # quit
+            env.icache[0x800]
+        self.assertEqual(env.icache.invalidations, 99)
+        return env.icache
+
+    def test_no_limit(self):
+        self.assertEqual(len(self.redecode(0).order), 0)
+
+    def test_limit(self):
+        self.assertLessEqual(len(self.redecode(10).order), 10)
+
+if __name__ == '__main__':
+    unittest.main()
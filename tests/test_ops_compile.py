@@ -0,0 +1,33 @@
+import unittest
+
+import zstory
+
+import ops_compile
+
+# main: call_vs 0x1008 -> g0, quit. then the routine at 0x1008, one
+# local, whose je has just the one operand
+def je_story(branch_byte):
+    return ('\x00\xe0\x3f\x04\x02\x10\xba\x00' +
+            '\x01\xc1\xbf\x01' + branch_byte + '\xb1')
+
+class OneOperandJeTest(unittest.TestCase):
+    def run_routine(self, branch_byte):
+        env = zstory.make_env(je_story(branch_byte))
+        env.compiler = ops_compile.RoutineCompiler(1)
+        zstory.run(env)
+        self.assertEqual(env.compiler.num_compiled(), 1)
+        return zstory.global_var(env, 0)
+
+    # nothing to match, so ?rtrue isn't taken, and rfalse is
+    def test_branch_on_true(self):
+        self.assertEqual(self.run_routine('\xc1'), 0)
+
+    def test_branch_on_false(self):
+        self.assertEqual(self.run_routine('\x41'), 1)
+
+    def test_compiles(self):
+        env = zstory.make_env(je_story('\xc1'))
+        self.assertIsNotNone(ops_compile.compile_routine(env, 0x1008))
+
+if __name__ == '__main__':
+    unittest.main()
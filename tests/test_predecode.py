@@ -0,0 +1,34 @@
+import unittest
+
+import zstory
+
+import predecode
+
+# main: call_vs 0x1400 -> g0, call_vs 0x1ffc -> g0, quit. neither is
+# a routine: 0x1400 has 0xff locals, and at 0x1ffc 15 locals would run
+# off the end (their values would, in v3/v4)
+def story():
+    code = '\x00\xe0\x3f\x05\x00\x10\xe0\x3f\x07\xff\x10\xba'
+    mem = bytearray(zstory.make_story(code))
+    mem[0x1400] = 0xff
+    mem[0x1ffc] = 0x0f
+    return str(mem)
+
+class NonRoutineTest(unittest.TestCase):
+    def setUp(self):
+        self.env = zstory.make_env('')
+        self.env.mem[:] = story()
+        self.predecoder = predecode.Predecoder(self.env)
+
+    def test_code_ptr(self):
+        self.assertIsNone(self.predecoder.routine_code_ptr(0x500))
+        self.assertIsNone(self.predecoder.routine_code_ptr(0x7ff))
+        self.assertIsNone(self.predecoder.routine_code_ptr(0x1000))
+
+    def test_walk(self):
+        self.predecoder.run() # in this thread, so an err() would fail the test
+        self.assertIsNotNone(self.predecoder.elapsed)
+        self.assertIn(0x1006, self.env.icache)
+
+if __name__ == '__main__':
+    unittest.main()
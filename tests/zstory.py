@@ -0,0 +1,46 @@
+# zstory.py (as in this file makes tiny story files for the tests)
+#
+# a v5 story with dyn mem up to 0x1000, globals at 0x100, and the
+# given code at 0x1000 onwards (the game starts at 0x1001), run on a
+# vterm.HeadlessScreen.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'xyppy'))
+
+import term
+term.get_size = lambda: (80, 25) # no tty needed
+
+import ops
+import vterm
+import zenv
+
+CODE = 0x1000
+
+def make_story(code):
+    mem = bytearray(0x2000)
+    mem[0] = 5
+    mem[0x04:0x06] = '\x10\x00' # high mem
+    mem[0x06:0x08] = '\x10\x01' # start pc
+    mem[0x0c:0x0e] = '\x01\x00' # globals
+    mem[0x0e:0x10] = '\x10\x00' # static mem
+    mem[CODE:CODE+len(code)] = code
+    return str(mem)
+
+def make_env(code):
+    env = zenv.Env(make_story(code))
+    ops.setup_opcodes(env)
+    env.output_buffer[1] = env.screen = vterm.HeadlessScreen(env)
+    return env
+
+# runs env until the game quits
+def run(env):
+    try:
+        while True:
+            zenv.run(env, 1000)
+    except SystemExit:
+        pass
+
+def global_var(env, num):
+    return env.u16(env.global_var_base + 2*num)
@@ -1,23 +1,86 @@
 import sys
+import atexit
+import argparse
+import signal
 import urllib2
 
 from debug import err
-from zenv import Env, step
+from zenv import Env, run, run_pair_report, print_pair_report
 import blorb
 import ops
+import ops_decode
+import ops_compile
+import accel
+import memo
+import undo
+import predecode
+import decode_cache
+import tracing
 import term
 
-def main():
-    if len(sys.argv) != 2:
-        prog_name = sys.argv[0]
-        if sys.argv[0].endswith('__main__.py'):
-            prog_name = '-m xyppy'
+def parse_args():
+    prog_name = sys.argv[0]
+    if sys.argv[0].endswith('__main__.py'):
+        prog_name = '-m xyppy'
+    parser = argparse.ArgumentParser(prog='python '+prog_name)
+    parser.add_argument('story', nargs='?', help='story file or url')
+    parser.add_argument('--trace', action='store_true',
+                        help='log every instruction to stderr as it runs '
+                             '(sending SIGUSR1 flips this on a running game)')
+    parser.add_argument('--pair-report', type=int, default=0, metavar='N',
+                        help='on exit, list the N most common op pairs run '
+                             '(turns superinstructions off)')
+    parser.add_argument('--icache-limit', type=int, default=0, metavar='N',
+                        help='keep at most N decoded instructions cached')
+    parser.add_argument('--icache-stats', action='store_true',
+                        help='on exit, show instruction cache hits/misses/evictions')
+    parser.add_argument('--dirty-stats', action='store_true',
+                        help='on exit, show how many pages of dynamic memory '
+                             'each turn wrote')
+    parser.add_argument('--check-state-hash', action='store_true',
+                        help='at each input, check the incremental state hash '
+                             'against hashing all of dynamic memory again')
+    parser.add_argument('--predecode', action='store_true',
+                        help='decode reachable code in the background at startup '
+                             '(and show how it went on exit)')
+    parser.add_argument('--decode-cache', metavar='DIR',
+                        help='keep decoded instructions in DIR between runs')
+    parser.add_argument('--no-accel', action='store_true',
+                        help="always run inform's veneer routines as z-code")
+    parser.add_argument('--accel-verify', action='store_true',
+                        help='run veneer routines both natively and as z-code, '
+                             'and report any difference')
+    parser.add_argument('--turn-memo', action='store_true',
+                        help='remember the outcome of each command from each '
+                             'game state, and replay it when they come up again. '
+                             'commands that save an undo state are never replayed, '
+                             'and inform games save one every turn, so this needs '
+                             '--undo-states 0 to do anything for them')
+    parser.add_argument('--undo-states', type=int, default=undo.MAX_STATES, metavar='N',
+                        help='keep up to N undo states in memory (0 turns undo off, '
+                             'default %(default)s)')
+    parser.add_argument('--undo-kb', type=int, default=undo.MAX_BYTES >> 10, metavar='N',
+                        help='keep undo states to about N KB in all (default %(default)s)')
+    parser.add_argument('--undo-stats', action='store_true',
+                        help='on exit, show how many undo states are kept, and '
+                             'how long saving and restoring them took')
+    parser.add_argument('--compile', type=int, default=0, metavar='N',
+                        help='compile routines to python once they have '
+                             'been called N times')
+    args = parser.parse_args()
+    if not args.story:
         print('usage examples:')
         print('    python '+prog_name+' STORY_FILE.z5')
         print('    python '+prog_name+' http://example.com/STORY_FILE.z5')
+        print('    python '+prog_name+' --pair-report 30 STORY_FILE.z5')
+        print('    python '+prog_name+' --compile 20 STORY_FILE.z5')
         sys.exit()
+    return args
+
+def main():
+    args = parse_args()
 
-    url = sys.argv[1]
+    url = args.story
     if any(map(url.startswith, ['http://', 'https://', 'ftp://'])):
         f = urllib2.urlopen(url)
         mem = f.read()
@@ -32,12 +95,71 @@ def main():
     if env.hdr.version not in [3,4,5,7,8]:
         err('unsupported z-machine version: '+str(env.hdr.version))
 
+    if args.pair_report:
+        ops_decode.FUSE = False
+        pair_counts = {}
+        # registered before term.init so it prints after the term is restored
+        atexit.register(print_pair_report, pair_counts, args.pair_report)
+
+    if args.decode_cache:
+        decode_cache.load(env, args.decode_cache)
+        atexit.register(decode_cache.save, env, args.decode_cache)
+
+    env.icache.limit = args.icache_limit
+    if args.icache_stats:
+        atexit.register(env.icache.report)
+    if args.dirty_stats:
+        atexit.register(env.dirty_report)
+    env.check_state_hash = args.check_state_hash
+
+    if not args.no_accel:
+        env.accel = accel.Accelerator(verify=args.accel_verify)
+        if args.accel_verify:
+            atexit.register(env.accel.report)
+
+    if args.turn_memo:
+        env.memo = memo.TurnMemo()
+        atexit.register(env.memo.report)
+
+    if args.undo_states > 0:
+        env.undo.max_states = args.undo_states
+        env.undo.max_bytes = args.undo_kb << 10
+        if args.undo_stats:
+            atexit.register(env.undo.report)
+    else:
+        env.undo = None
+        env.hdr.flags2 &= ~0b10000 # as set_standard_flags would have
+
+    if args.compile:
+        env.compiler = ops_compile.RoutineCompiler(args.compile)
+
+    if args.predecode:
+        predecoder = predecode.Predecoder(env)
+        atexit.register(predecoder.report)
+
     term.init(env)
     env.screen.first_draw()
     ops.setup_opcodes(env)
+    if args.trace:
+        tracing.set_tracing(env, True)
+    if args.predecode:
+        predecoder.start()
+
+    # the switch happens between runs, not in the handler, so it
+    # never lands in the middle of decoding or caching an inst
+    trace_toggles = []
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: trace_toggles.append(signum))
+        signal.siginterrupt(signal.SIGUSR1, False) # don't break the input read
     try:
         while True:
-            step(env)
+            if args.pair_report:
+                run_pair_report(env, 100000, pair_counts)
+            else:
+                run(env, 100000)
+            if trace_toggles:
+                del trace_toggles[:]
+                tracing.toggle_tracing(env)
     except KeyboardInterrupt:
         pass
 
@@ -0,0 +1,513 @@
+# accel.py (as in this file runs some of inform's veneer in python)
+#
+# inform 6 stories spend a lot of their time in a handful of small
+# routines the compiler adds to every game (the "veneer"): property
+# lookup, ofclass, and working out what sort of thing a value is.
+# each of those is written out below as the z-code inform compiles it
+# to, and when a routine in static mem is first called its code is
+# checked against them. if it's an exact match (same ops, same vars,
+# same branches, constants only where the listing has a K:/R:/* slot),
+# later calls to it skip the z-code and run the python version here,
+# which does exactly what that listing does.
+#
+# the python versions never write anything, so a call is just a
+# return value. the error paths (the ones calling RT__Err) return None
+# instead, and the call then runs as z-code after all.
+#
+# CA__Pr (message sends) isn't here: it calls back into the game's own
+# routines, which a python function can't do from inside a call op.
+
+from zmath import to_signed_word
+from debug import warn
+
+import ops
+import ops_decode
+import ops_impl
+import zenv
+
+# listing syntax: one inst per line, optionally 'label:' first.
+#   L0-L14, SP       local var n / the stack
+#   G:name           some global, remembered as name (same var each time)
+#   K:name           some constant, remembered as name
+#   R:Name           a routine that has to be veneer routine Name too
+#   *                any constant (RT__Err and its message strings)
+#   123, $7fff, -1   exactly that constant
+#   -> var           store
+#   ?label, ?~label  branch (label can be rtrue/rfalse)
+
+UNSIGNED_COMPARE = '''
+        je L0 L1 ?rfalse
+        jl L0 0 ?~a
+        jl L1 0 ?~rtrue
+a:      jl L0 0 ?b
+        jl L1 0 ?~b
+        ret -1
+b:      and_ L0 $7fff -> L2
+        and_ L1 $7fff -> L3
+        jg L2 L3 ?rtrue
+        ret -1
+'''
+
+Z_REGION = '''
+        jz L0 ?rfalse
+        jl L0 1 ?a
+        jg L0 K:top_object ?~rtrue
+a:      call R:Unsigned__Compare L0 K:strings_offset -> SP
+        jl SP 0 ?b
+        ret 3
+b:      call R:Unsigned__Compare L0 K:code_offset -> SP
+        jl SP 0 ?c
+        ret 2
+c:      rfalse
+'''
+
+OC_CL = '''
+        jl L0 1 ?notobj
+        jg L0 K:top_object ?~isobj
+notobj: je L1 3 4 ?~rfalse
+        call_2s R:Z__Region L0 -> SP
+        sub L1 1 -> SP
+        je SP SP ?~rfalse
+        rtrue
+isobj:  je L1 1 ?~a
+        jg L0 4 ?~rtrue
+        jin L0 1 ?rtrue
+        rfalse
+a:      je L1 2 ?~b
+        jg L0 4 ?~rfalse
+        jin L0 1 ?rfalse
+        rtrue
+b:      je L1 3 4 ?rfalse
+        jin L1 1 ?c
+        call_vn * * L1 -1
+        rfalse
+c:      get_prop_addr L0 2 -> L3
+        jz L3 ?rfalse
+        get_prop_addr L0 2 -> SP
+        get_prop_len SP -> L4
+        store L2 0
+loop:   div L4 2 -> SP
+        jl L2 SP ?~done
+        loadw L3 L2 -> SP
+        je SP L1 ?rtrue
+        inc L2
+        jump loop
+done:   rfalse
+'''
+
+RA_PR = '''
+        jl L1 64 ?~a
+        jg L1 0 ?~a
+        get_prop_addr L0 L1 -> SP
+        ret_popped
+a:      and_ L1 $8000 -> SP
+        jz SP ?b
+        and_ L1 $ff -> SP
+        loadw K:classes_table SP -> L4
+        get_prop_addr L4 3 -> SP
+        jz SP ?rfalse
+        call R:OC__Cl L0 L4 -> SP
+        jz SP ?rfalse
+        and_ L1 $7f00 -> SP
+        div SP $100 -> L1
+        get_prop L4 3 -> L2
+cloop:  jg L1 0 ?~cdone
+        dec L1
+        loadb L2 2 -> SP
+        add L2 SP -> SP
+        add SP 3 -> L2
+        jump cloop
+cdone:  add L2 3 -> SP
+        ret_popped
+b:      get_prop_addr L0 3 -> SP
+        jz SP ?rfalse
+        jin L0 1 ?meta
+        jin L0 2 ?meta
+        jin L0 3 ?meta
+        jin L0 4 ?~c
+meta:   jl L1 64 ?rfalse
+        jl L1 72 ?~rfalse
+c:      je G:self L0 ?~d
+        or_ L1 $8000 -> L3
+d:      get_prop L0 3 -> L2
+loop:   loadw L2 0 -> SP
+        jz SP ?done
+        loadw L2 0 -> SP
+        je SP L1 L3 ?~next
+        add L2 3 -> SP
+        ret_popped
+next:   loadb L2 2 -> SP
+        add L2 SP -> SP
+        add SP 3 -> L2
+        jump loop
+done:   rfalse
+'''
+
+RL_PR = '''
+        jl L1 64 ?~a
+        jg L1 0 ?~a
+        get_prop_addr L0 L1 -> SP
+        get_prop_len SP -> SP
+        ret_popped
+a:      call R:RA__Pr L0 L1 -> L2
+        jz L2 ?rfalse
+        sub L2 1 -> SP
+        loadb SP 0 -> SP
+        ret_popped
+'''
+
+RV_PR = '''
+        jl L1 64 ?~a
+        jg L1 0 ?~a
+        get_prop L0 L1 -> SP
+        ret_popped
+a:      call R:RA__Pr L0 L1 -> L2
+        jz L2 ?~b
+        call_vn * * L0 L1
+        rtrue
+b:      loadw L2 0 -> SP
+        ret_popped
+'''
+
+# the python halves. each make_* gets what the listing remembered
+# (K:/G: values, and R: routines as their python versions), and
+# returns a function of env plus the routine's locals.
+
+def make_unsigned_compare(env, found):
+    def unsigned_compare(env, x=0, y=0, u=0, v=0):
+        if x == y:
+            return 0
+        return 1 if x > y else 0xffff
+    return unsigned_compare
+
+def make_z_region(env, found):
+    top_object = to_signed_word(found['top_object'])
+    strings_offset, code_offset = found['strings_offset'], found['code_offset']
+    unsigned_compare = found['Unsigned__Compare']
+    def z_region(env, addr=0):
+        if addr == 0:
+            return 0
+        if 1 <= to_signed_word(addr) <= top_object:
+            return 1
+        if unsigned_compare(env, addr, strings_offset) != 0xffff:
+            return 3
+        if unsigned_compare(env, addr, code_offset) != 0xffff:
+            return 2
+        return 0
+    return z_region
+
+def make_oc_cl(env, found):
+    top_object = to_signed_word(found['top_object'])
+    z_region = found['Z__Region']
+    def oc_cl(env, obj=0, cla=0, j=0, a=0, n=0):
+        if not 1 <= to_signed_word(obj) <= top_object:
+            if cla != 3 and cla != 4:
+                return 0
+            return int(z_region(env, obj) == ((cla - 1) & 0xffff))
+        if cla == 1:
+            return int(to_signed_word(obj) <= 4 or jin(env, obj, 1))
+        if cla == 2:
+            return int(not (to_signed_word(obj) <= 4 or jin(env, obj, 1)))
+        if cla == 3 or cla == 4:
+            return 0
+        if not jin(env, cla, 1):
+            return None # RT__Err
+        a = get_prop_addr(env, obj, 2)
+        if a == 0:
+            return 0
+        n = get_prop_len(env, get_prop_addr(env, obj, 2)) # 0 to 64
+        for j in xrange(n // 2):
+            if loadw(env, a, j) == cla:
+                return 1
+        return 0
+    return oc_cl
+
+def make_ra_pr(env, found):
+    classes_table, self_var = found['classes_table'], found['self']
+    oc_cl = found['OC__Cl']
+    def ra_pr(env, obj=0, identifier=0, i=0, otherid=0, cla=0):
+        if 0 < to_signed_word(identifier) < 64:
+            return get_prop_addr(env, obj, identifier)
+        if identifier & 0x8000:
+            # a class's property, by way of its class table entry
+            cla = loadw(env, classes_table, identifier & 0xff)
+            if get_prop_addr(env, cla, 3) == 0:
+                return 0
+            is_member = oc_cl(env, obj, cla)
+            if not is_member:
+                return is_member # 0, or None to have the z-code complain
+            identifier = (identifier & 0x7f00) >> 8
+            i = get_prop(env, cla, 3)
+            if i is None:
+                return None
+            while identifier > 0:
+                identifier -= 1
+                i = (i + loadb(env, i, 2) + 3) & 0xffff
+            return (i + 3) & 0xffff
+        if get_prop_addr(env, obj, 3) == 0:
+            return 0
+        if ops_impl.get_parent_num(env, obj) in (1, 2, 3, 4):
+            if not 64 <= to_signed_word(identifier) < 72:
+                return 0
+        if ops_impl.get_var(env, self_var) == obj:
+            otherid = identifier | 0x8000
+        # walk the individual property table
+        i = get_prop(env, obj, 3)
+        if i is None:
+            return None
+        while True:
+            prop_id = loadw(env, i, 0)
+            if prop_id == 0:
+                return 0
+            if prop_id == identifier or prop_id == otherid:
+                return (i + 3) & 0xffff
+            i = (i + loadb(env, i, 2) + 3) & 0xffff
+    return ra_pr
+
+def make_rl_pr(env, found):
+    ra_pr = found['RA__Pr']
+    def rl_pr(env, obj=0, identifier=0, x=0):
+        if 0 < to_signed_word(identifier) < 64:
+            return get_prop_len(env, get_prop_addr(env, obj, identifier))
+        x = ra_pr(env, obj, identifier)
+        if not x:
+            return x
+        return loadb(env, (x - 1) & 0xffff, 0)
+    return rl_pr
+
+def make_rv_pr(env, found):
+    ra_pr = found['RA__Pr']
+    def rv_pr(env, obj=0, identifier=0, x=0):
+        if 0 < to_signed_word(identifier) < 64:
+            return get_prop(env, obj, identifier)
+        x = ra_pr(env, obj, identifier)
+        if not x:
+            return None # RT__Err
+        return loadw(env, x, 0)
+    return rv_pr
+
+# these do what the op of the same name does, but hand back the result
+def get_prop_addr(env, obj, prop_num):
+    if obj == 0:
+        return 0
+    return ops_impl.compat_get_prop_addr(env, obj, prop_num)
+
+def get_prop_len(env, prop_data_addr):
+    if prop_data_addr == 0:
+        return 0
+    size, num = ops_impl.get_sizenum_from_addr(env, prop_data_addr)
+    return size
+
+def get_prop(env, obj, prop_num):
+    prop_addr = ops_impl.compat_get_prop_addr(env, obj, prop_num)
+    if prop_addr == 0:
+        return ops_impl.get_default_prop(env, prop_num)
+    size, num = ops_impl.get_sizenum_from_addr(env, prop_addr)
+    if size == 1:
+        return env.u8(prop_addr)
+    if size == 2 or ops_impl.FORGIVING_GET_PROP:
+        return env.u16(prop_addr)
+    return None # the op errs out
+
+def loadw(env, array_addr, word_index):
+    word_loc = 0xffff & (array_addr + 2*to_signed_word(word_index))
+    return env.u16(word_loc)
+
+def loadb(env, array_addr, byte_index):
+    return env.u8(0xffff & (array_addr + to_signed_word(byte_index)))
+
+def jin(env, obj1, obj2):
+    return ops_impl.get_parent_num(env, obj1) == obj2
+
+def parse_listing(text):
+    insts, labels = [], {}
+    for line in text.strip().splitlines():
+        words = line.split()
+        if words[0].endswith(':'):
+            labels[words.pop(0)[:-1]] = len(insts)
+        name, words = words[0], words[1:]
+        store = branch = None
+        if '->' in words:
+            store = parse_operand(words[words.index('->')+1])
+            words = words[:words.index('->')]
+        if words and words[-1].startswith('?'):
+            target = words.pop()[1:]
+            branch = not target.startswith('~'), target.lstrip('~')
+        if name == 'jump':
+            operands = [('label', words[0])]
+        else:
+            operands = [parse_operand(word) for word in words]
+        insts.append((name, operands, store, branch))
+    return insts, labels
+
+def parse_operand(word):
+    if word == 'SP':
+        return 'var', 0
+    if word[0] == 'L' and word[1:].isdigit():
+        return 'var', int(word[1:]) + 1
+    if word == '*':
+        return 'any', None
+    if word[:2] in ('G:', 'K:', 'R:'):
+        return word[0], word[2:]
+    if word[0] == '$':
+        return 'const', int(word[1:], 16)
+    return 'const', int(word) & 0xffff
+
+# name -> (num locals, listing, make_*)
+VENEER = {}
+for name, num_locals, listing, make_native in [
+        ('Unsigned__Compare', 4, UNSIGNED_COMPARE, make_unsigned_compare),
+        ('Z__Region', 1, Z_REGION, make_z_region),
+        ('OC__Cl', 5, OC_CL, make_oc_cl),
+        ('RA__Pr', 5, RA_PR, make_ra_pr),
+        ('RL__Pr', 3, RL_PR, make_rl_pr),
+        ('RV__Pr', 3, RV_PR, make_rv_pr)]:
+    VENEER[name] = num_locals, parse_listing(listing), make_native
+
+# ops whose first operand is a var number written as a constant
+var_num_ops = ops_decode.var_ref_ops | set(['store'])
+
+class Accelerator(object):
+    def __init__(self, verify=False):
+        self.verify = verify
+        self.found = {} # packed addr -> (name, python version), or None
+        self.calls = {} # packed addr -> [calls, fell back, didn't agree]
+
+    # the python version of the routine at packed_addr, if it's
+    # one of the veneer's (used by ops_impl.read_routine_header)
+    def native_for(self, env, packed_addr):
+        found = self.find(env, packed_addr)
+        if found is None:
+            return None
+        name, native = found
+        if self.verify:
+            warn('accel:', name, 'found at', hex(packed_addr))
+            self.calls[packed_addr] = [0, 0, 0]
+            return self.make_checked(env, packed_addr, name, native)
+        return native
+
+    def find(self, env, packed_addr):
+        if packed_addr not in self.found:
+            self.found[packed_addr] = None # in case it somehow refers to itself
+            for name in VENEER:
+                native = self.match(env, packed_addr, name)
+                if native:
+                    self.found[packed_addr] = name, native
+                    break
+        return self.found[packed_addr]
+
+    def match(self, env, packed_addr, name):
+        num_locals, (listing, labels), make_native = VENEER[name]
+        call_addr = ops_impl.unpack_addr_call(env, packed_addr)
+        if not env.static_mem_base <= call_addr < len(env.mem):
+            return None
+        if env.mem[call_addr] != num_locals:
+            return None
+        local_vars, pc = ops_impl.parse_call_header(env, call_addr)
+        if any(local_vars): # the python versions start their locals at 0
+            return None
+
+        found, pcs, targets, callees = {}, [], [], set()
+        for inst_name, operands, store, branch in listing:
+            try:
+                fields = ops_decode.decode_fields(env, pc)
+            except (KeyError, IndexError):
+                return None
+            (is_extended, opcode, consts, var_op_info, store_var,
+             store_ptr, branch_on, branch_offset, branch_ptr, next_pc) = fields
+            op = (ops.ext_dispatch if is_extended else ops.dispatch)[opcode]
+            if op.__name__ != inst_name or len(consts) != len(operands):
+                return None
+
+            actual = [('const', value) for value in consts]
+            for i, var_num in var_op_info:
+                actual[i] = 'var', var_num
+            if inst_name in var_num_ops and actual[0][0] == 'const':
+                actual[0] = 'var', actual[0][1]
+            for (kind, want), (got_kind, got) in zip(operands, actual):
+                if kind == 'label':
+                    if got_kind != 'const':
+                        return None
+                    targets.append((next_pc + to_signed_word(got) - 2, want))
+                elif kind == 'G':
+                    if got_kind != 'var' or got < 16 or found.setdefault(want, got) != got:
+                        return None
+                elif kind in ('K', 'R'):
+                    if got_kind != 'const' or found.setdefault(want, got) != got:
+                        return None
+                    if kind == 'R':
+                        callees.add(want)
+                elif kind == 'any':
+                    if got_kind != 'const':
+                        return None
+                elif (kind, want) != (got_kind, got):
+                    return None
+
+            if (store_var is None) != (store is None):
+                return None
+            if store is not None and store[1] != store_var:
+                return None
+            if (branch_offset is None) != (branch is None):
+                return None
+            if branch is not None:
+                want_on, target = branch
+                if branch_on != want_on:
+                    return None
+                if branch_offset in (0, 1):
+                    if target != ('rtrue' if branch_offset else 'rfalse'):
+                        return None
+                else:
+                    targets.append((next_pc + branch_offset - 2, target))
+            pcs.append(pc)
+            pc = next_pc
+
+        for target_pc, label in targets:
+            if label not in labels or pcs[labels[label]] != target_pc:
+                return None
+        for callee_name in callees:
+            callee = self.find(env, found[callee_name])
+            if callee is None or callee[0] != callee_name:
+                return None
+            found[callee_name] = callee[1]
+        return make_native(env, found)
+
+    # for --accel-verify: every call runs both ways, and the z-code's
+    # answer is the one that's kept
+    def make_checked(self, env, packed_addr, name, native):
+        counts = self.calls[packed_addr]
+        call_addr = ops_impl.unpack_addr_call(env, packed_addr)
+        local_vars, code_ptr = ops_impl.parse_call_header(env, call_addr)
+        def checked(env, *args):
+            counts[0] += 1
+            expected = native(env, *args)
+            mark = env.dirty_mark()
+            result = run_zcode(env, code_ptr, len(local_vars), args)
+            if expected is None:
+                counts[1] += 1
+            elif expected != result:
+                counts[2] += 1
+                warn('accel:', name, 'gave', expected, 'but the z-code gave', result,
+                     'for', list(args))
+            if env.dirty_pages(mark):
+                warn('accel:', name, 'wrote to memory, for', list(args))
+            return result
+        return checked
+
+    def report(self):
+        warn('accel:', len(self.calls), 'veneer routines found')
+        for packed_addr, (calls, fell_back, disagreed) in sorted(self.calls.items()):
+            name = self.found[packed_addr][0]
+            warn('   ', name.ljust(18), hex(packed_addr), str(calls).rjust(10), 'calls,',
+                 fell_back, 'left to z-code,', disagreed, 'disagreed')
+
+# runs the routine as z-code to its return, from inside the call op
+def run_zcode(env, code_ptr, num_locals, args):
+    stack, fp = env.stack, env.fp
+    stack.extend((env.pc, 0, len(args), num_locals, fp)) # result to the stack
+    env.fp = len(stack)
+    stack.extend(args)
+    stack.extend([0] * (num_locals - len(args)))
+    env.pc = code_ptr
+    while env.fp > fp:
+        zenv.step(env)
+    return stack.pop()
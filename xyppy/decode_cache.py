@@ -0,0 +1,56 @@
+# decode_cache.py (as in this file keeps decoded insts between runs)
+#
+# the byte-level decode of every static mem inst (ops_decode.decode_fields)
+# gets written out on exit, and read back in one go on the next start,
+# so only the cheap part of decoding (building the closures) is left.
+# files are keyed by the story's release, serial and checksum, plus a
+# format number (bump it if decode_fields changes) and the python
+# version (marshal's format isn't promised to stay put across them).
+
+import marshal
+import os
+import sys
+import tempfile
+
+from debug import warn
+
+FORMAT = 1
+
+def cache_path(env, cache_dir):
+    hdr = env.hdr
+    serial = ''.join(map(chr, hdr.serial))
+    serial = ''.join(c if c.isalnum() else '_' for c in serial)
+    name = 'r%d-%s-%04x-f%d-py%d%d.decodes' % (hdr.release, serial, hdr.checksum,
+                                               FORMAT, sys.version_info[0], sys.version_info[1])
+    return os.path.join(cache_dir, name)
+
+def load(env, cache_dir):
+    fields = {}
+    path = cache_path(env, cache_dir)
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                fields = marshal.loads(f.read())
+            if not isinstance(fields, dict):
+                raise ValueError('not a decode cache')
+        except (IOError, EOFError, ValueError, TypeError):
+            warn('decode cache: could not read', path, '(ignoring it)')
+            fields = {}
+    env.decoded_fields = fields
+    return len(fields)
+
+def save(env, cache_dir):
+    fields = env.decoded_fields
+    if not fields:
+        return
+    path = cache_path(env, cache_dir)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # other sessions may be reading it, so swap the whole file in at once
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(marshal.dumps(dict(fields)))
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        warn('decode cache: could not write', path, '('+str(e)+')')
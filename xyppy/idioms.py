@@ -0,0 +1,254 @@
+# idioms.py (as in this file runs some whole loops as one op)
+#
+# inform code (inform 7's block values especially) copies, fills and
+# searches memory with tiny loops that do one loadb/storeb or
+# loadw/storew each time around. when make_inst builds the inst at the
+# top of one of these (in static mem, so the loop can't change under
+# us), the inst gets wrapped so that reaching it does all the remaining
+# iterations at once on env.mem, and leaves the counter, the stack and
+# memory just as the loop would have, at the pc the loop would leave by.
+# anything the bulk version can't do exactly (addresses that wrap or
+# run off dyn mem, writes landing on a global the loop reads) runs the
+# plain inst instead, one time around.
+#
+# the two loop shapes, with i a local and the other operands
+# constants, other locals, or globals:
+#
+#   top: jl i bound ?~out          top: <body>
+#        <body>                         inc_chk i bound ?~top
+#        inc i
+#        jump top
+#
+# and the bodies:
+#
+#   loadb/w base i -> sp, storeb/w base2 i sp      (copy)
+#   storeb/w base i value                          (fill)
+#   loadb/w base i -> sp, je sp value ?found       (search)
+
+from zmath import to_signed_word
+
+import ops
+import ops_decode
+
+load_ops = {'loadb': 1, 'loadw': 2}
+store_ops = {'storeb': 1, 'storew': 2}
+
+# a wrapped inst for the loop starting at pc, or inst as it was
+def whole_loop(env, pc, inst):
+    if inst.op.__name__ not in ('jl', 'loadb', 'loadw', 'storeb', 'storew'):
+        return inst
+    loop = find_loop(env, pc)
+    if loop is None:
+        return inst
+    run_loop = make_loop(env, *loop)
+    def loop_inst(env):
+        pc = run_loop(env)
+        if pc is None:
+            return inst(env)
+        env.pc = pc
+        return pc
+    loop_inst.op, loop_inst.opinfo, loop_inst.next_pc = inst.op, inst.opinfo, inst.next_pc
+    return loop_inst
+
+# (name, operands, store var, branch_on, branch target, next_pc) for
+# the count insts from pc, operands as ('var', num) or ('const', val),
+# and the branch target a pc or ('return', val)
+def read_insts(env, pc, count):
+    insts = []
+    for i in xrange(count):
+        try:
+            fields = ops_decode.decode_fields(env, pc)
+        except (KeyError, IndexError):
+            break
+        (is_extended, opcode, consts, var_op_info, store_var,
+         store_ptr, branch_on, branch_offset, branch_ptr, next_pc) = fields
+        if is_extended:
+            break
+        operands = [('const', val) for val in consts]
+        for j, var_num in var_op_info:
+            operands[j] = 'var', var_num
+        target = None
+        if branch_offset == 0 or branch_offset == 1:
+            target = 'return', branch_offset
+        elif branch_offset is not None:
+            target = next_pc + branch_offset - 2
+        name = ops.dispatch[opcode].__name__
+        insts.append((name, operands, store_var, branch_on, target, next_pc))
+        pc = next_pc
+    return insts
+
+def is_local(operand):
+    return operand[0] == 'var' and 0 < operand[1] < 16
+
+# a const, or a var other than the stack and the counter
+def is_invariant(operand, counter):
+    return operand[0] == 'const' or operand[1] not in (0, counter)
+
+# returns (head pc, counter var, bound, exit, body) or None, where
+# exit is where the loop goes when the count runs out
+def find_loop(env, pc):
+    insts = read_insts(env, pc, 5)
+    if not insts:
+        return None
+    name, operands, store_var, branch_on, target, next_pc = insts[0]
+    if name == 'jl':
+        counter, bound = operands
+        if not is_local(counter) or not is_invariant(bound, counter[1]) or branch_on:
+            return None
+        body = find_body(insts[1:], counter[1])
+        if body is None:
+            return None
+        rest = insts[1+body[0]:]
+        if len(rest) < 2:
+            return None
+        inc, jump = rest[:2]
+        if inc[0] != 'inc' or inc[1] != [('const', counter[1])]:
+            return None
+        if jump[0] != 'jump' or jump[1][0][0] != 'const':
+            return None
+        if jump[5] + to_signed_word(jump[1][0][1]) - 2 != pc:
+            return None
+        return pc, 'top', counter[1], bound, target, body[1:-1]
+    body = find_body(insts, None)
+    if body is None:
+        return None
+    rest = insts[body[0]:]
+    if not rest:
+        return None
+    name, operands, store_var, branch_on, target, next_pc = rest[0]
+    if name != 'inc_chk' or operands[0][0] != 'const' or branch_on or target != pc:
+        return None
+    counter = operands[0][1]
+    if not 0 < counter < 16 or counter != body[-1]:
+        return None
+    if not is_invariant(operands[1], counter):
+        return None
+    return pc, 'bottom', counter, operands[1], next_pc, body[1:-1]
+
+# returns (num insts, kind, unit, operands..., counter) or None. with
+# counter None, the counter is taken from the body's index operand
+def find_body(insts, counter):
+    if not insts:
+        return None
+    name, operands, store_var, branch_on, target, next_pc = insts[0]
+    if name in store_ops:
+        base, index, value = operands
+        if index[0] != 'var' or counter not in (None, index[1]):
+            return None
+        counter = index[1]
+        if not is_invariant(base, counter) or not is_invariant(value, counter):
+            return None
+        return 1, 'fill', store_ops[name], base, value, counter
+    if name not in load_ops or len(insts) < 2 or store_var != 0:
+        return None
+    base, index = operands
+    if index[0] != 'var' or counter not in (None, index[1]):
+        return None
+    counter = index[1]
+    if not is_invariant(base, counter):
+        return None
+    unit = load_ops[name]
+    name, operands, store_var, branch_on, target, next_pc = insts[1]
+    if store_ops.get(name) == unit:
+        dest, index, value = operands
+        if index != ('var', counter) or value != ('var', 0) or not is_invariant(dest, counter):
+            return None
+        return 2, 'copy', unit, base, dest, counter
+    if name == 'je' and len(operands) == 2 and operands[0] == ('var', 0):
+        if not is_invariant(operands[1], counter):
+            return None
+        return 2, 'search', unit, base, operands[1], branch_on, target, counter
+    return None
+
+def reader(operand):
+    kind, val = operand
+    if kind == 'const':
+        return lambda env: val
+    return lambda env: ops.get_var(env, val)
+
+# the mem addrs of any globals among operands
+def global_addrs(env, operands):
+    addrs = []
+    for kind, val in operands:
+        if kind == 'var' and val >= 16:
+            addrs.append(env.global_var_base + 2*(val - 16))
+    return addrs
+
+def leave_by(target):
+    if isinstance(target, tuple):
+        def leave(env):
+            ops.handle_return(env, target[1])
+            return env.pc
+    else:
+        def leave(env):
+            return target
+    return leave
+
+def make_loop(env, head_pc, shape, counter, bound, exit_to, body):
+    kind, unit = body[0], body[1]
+    read_bound = reader(bound)
+    leave = leave_by(exit_to)
+    if kind == 'search':
+        found = leave_by(body[5])
+        read_value, want_equal = reader(body[3]), body[4]
+    else:
+        read_value = reader(body[3])
+    read_base = reader(body[2])
+    watched = global_addrs(env, [bound, body[2], body[3]])
+
+    def run_loop(env):
+        start = to_signed_word(ops.get_var(env, counter))
+        end = to_signed_word(read_bound(env))
+        if shape == 'top':
+            count = max(end - start, 0)
+        else:
+            count = max(end - start + 1, 1)
+        if start + count > 0x7fff:
+            return None
+
+        base = read_base(env) + start*unit
+        size = count*unit
+        mem = env.mem
+        if base < 0 or base + size > min(len(mem), 0x10000):
+            return None
+
+        if kind == 'search':
+            value = read_value(env)
+            for i in xrange(count):
+                addr = base + i*unit
+                got = mem[addr] if unit == 1 else mem[addr] << 8 | mem[addr+1]
+                if (got == value) == want_equal:
+                    ops.set_var(env, counter, start + i)
+                    return found(env)
+            ops.set_var(env, counter, start + count)
+            return leave(env)
+
+        if kind == 'copy':
+            dest = read_value(env) + start*unit
+        else:
+            dest = base
+        if size:
+            if not 0x36 < dest or dest + size > env.static_mem_base:
+                return None
+            for addr in watched:
+                if dest - 2 < addr < dest + size:
+                    return None
+            env.own_mem()
+            mem = env.mem
+            if kind == 'fill':
+                value = read_value(env)
+                if unit == 1:
+                    mem[dest:dest+size] = chr(value & 0xff) * count
+                else:
+                    mem[dest:dest+size] = (chr(value >> 8 & 0xff) + chr(value & 0xff)) * count
+            elif base < dest < base + size:
+                # each write lands ahead of a read still to come
+                for addr in xrange(0, size, unit):
+                    mem[dest+addr:dest+addr+unit] = mem[base+addr:base+addr+unit]
+            else:
+                mem[dest:dest+size] = mem[base:base+size]
+            env.dyn_mem_written(dest, dest+size)
+        ops.set_var(env, counter, start + count)
+        return leave(env)
+
+    return run_loop
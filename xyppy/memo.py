@@ -0,0 +1,138 @@
+# memo.py (as in this file remembers whole turns and replays them)
+#
+# a turn runs from a line of input being read to the next read op
+# wanting one. given the same machine state (env.state_hash(), plus
+# the screen/stream state and the read's operands) and the same line,
+# a turn always ends the same way, so the first time around its end
+# state is kept: the pages of dyn mem it wrote, the stack and pc, the
+# read op it ended at, and every call it made on env.screen (with the
+# cursor/window state at each). the next time, all of that is put
+# back instead of running the turn again. screen calls are replayed
+# for real, so the screen itself (paging, wrapping) can't tell.
+#
+# turns that ask for input on the way (read_char, save/restore file
+# names), pull numbers from an unseeded rng, or restart are tainted:
+# nothing of them is kept. a seeded rng is fine, its state is part of
+# the key and is put back too.
+
+import random
+
+from debug import warn
+
+class TurnMemo(object):
+    def __init__(self):
+        self.turns = {} # key -> Turn
+        self.recording = None # (key, dirty mark, screen calls), during a turn
+        self.screen = None # the real one, while env.screen records
+        self.hits = 0
+        self.misses = 0
+        self.tainted = 0
+
+    # from handle_read, with a line just read for opinfo. returns the
+    # opinfo of the read a replayed turn ended at, or None if the turn
+    # has to run (and is now being recorded)
+    def start_turn(self, env, opinfo, line):
+        key = (env.state_hash(), screen_state(env), stream_state(env),
+               opinfo.pc, tuple(opinfo.operands), rng_state(env), line)
+        turn = self.turns.get(key)
+        if turn:
+            self.hits += 1
+            return turn.replay(env)
+        self.misses += 1
+        self.recording = key, env.dirty_mark(), []
+        self.screen = env.screen
+        env.screen = RecordingScreen(self, env)
+        return None
+
+    # from handle_read, before reading a line for opinfo
+    def end_turn(self, env, opinfo):
+        if not self.recording:
+            return
+        key, mark, calls = self.recording
+        self.stop_recording(env)
+        self.turns[key] = Turn(env, mark, opinfo, calls)
+
+    # for anything that makes the current turn unrepeatable
+    def taint(self, env):
+        if self.recording:
+            self.tainted += 1
+            self.stop_recording(env)
+
+    def stop_recording(self, env):
+        env.screen = self.screen
+        self.recording = self.screen = None
+
+    def report(self):
+        warn('turn memo:', len(self.turns), 'turns kept,', self.hits, 'replayed,',
+             self.misses, 'run,', self.tainted, 'of those tainted')
+
+class Turn(object):
+    def __init__(self, env, mark, opinfo, calls):
+        self.pages = []
+        for page in env.dirty_pages(mark):
+            start, end = env.page_range(page)
+            self.pages.append((start, end, str(env.mem[start:end])))
+        self.stack, self.fp, self.pc = list(env.stack), env.fp, env.pc
+        self.opinfo, self.operands = opinfo, list(opinfo.operands)
+        self.calls = calls
+        self.screen_state = screen_state(env)
+        self.stream_state = stream_state(env)
+        self.rng_seeded = env.rng_seeded
+        self.rng = random.getstate() if env.rng_seeded else None
+
+    def replay(self, env):
+        env.own_mem()
+        for start, end, data in self.pages:
+            env.mem[start:end] = data
+            env.dyn_mem_written(start, end)
+        env.stack[:] = self.stack
+        env.fp, env.pc = self.fp, self.pc
+        screen = env.screen
+        for state, name, args in self.calls:
+            set_screen_state(env, state)
+            getattr(screen, name)(*args)
+        set_screen_state(env, self.screen_state)
+        set_stream_state(env, self.stream_state)
+        env.rng_seeded = self.rng_seeded
+        if self.rng:
+            random.setstate(self.rng)
+        if self.opinfo.has_dynamic_operands:
+            self.opinfo.operands = list(self.operands)
+        return self.opinfo
+
+# stands in for env.screen during a recorded turn
+class RecordingScreen(object):
+    def __init__(self, memo, env):
+        self.memo, self.env = memo, env
+    def __getattr__(self, name):
+        memo, env = self.memo, self.env
+        method = getattr(memo.screen, name)
+        if name in ('get_line_of_input', 'getch'):
+            memo.taint(env)
+            return method
+        calls = memo.recording[2]
+        def record(*args):
+            calls.append((screen_state(env), name, args))
+            return method(*args)
+        return record
+
+# what the screen looks at in env
+def screen_state(env):
+    return (env.cursor[0], env.cursor[1], env.current_window, env.top_window_height,
+            env.text_style, env.fg_color, env.bg_color, env.use_buffered_output)
+def set_screen_state(env, state):
+    (env.cursor[0], env.cursor[1], env.current_window, env.top_window_height,
+     env.text_style, env.fg_color, env.bg_color, env.use_buffered_output) = state
+
+def stream_state(env):
+    return (frozenset(env.selected_ostreams), tuple(env.memory_ostream_stack),
+            env.output_buffer[2], env.output_buffer[3], env.output_buffer[4])
+def set_stream_state(env, state):
+    selected, stack, env.output_buffer[2], env.output_buffer[3], env.output_buffer[4] = state
+    env.selected_ostreams = set(selected)
+    env.memory_ostream_stack = list(stack)
+
+def rng_state(env):
+    if env.rng_seeded:
+        return hash(random.getstate())
+    return None
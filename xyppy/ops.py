@@ -1,12 +1,17 @@
 from ops_impl import *
+from ops_impl_compat import setup_compat
 
-dispatch = {}
-has_store_var = {}
-has_branch_var = {}
+import ops_impl
 
-ext_dispatch = {}
-ext_has_store_var = {}
-ext_has_branch_var = {}
+# indexed by opcode (or ext opcode), filled in per story by setup_opcodes().
+# they're lists, not dicts, so the decoder's lookups are plain indexing.
+dispatch = [None] * 256
+has_store_var = [False] * 256
+has_branch_var = [False] * 256
+
+ext_dispatch = [None] * 256
+ext_has_store_var = [False] * 256
+ext_has_branch_var = [False] * 256
 
 def op(opcode, f, svar=False, bvar=False):
     dispatch[opcode] = f
@@ -20,6 +25,15 @@ def ext(opcode, f, svar=False, bvar=False):
 
 def setup_opcodes(env):
 
+    # everything version-dependent gets decided here, once:
+    # which op sits at each opcode, and which compat helpers they call
+    for table in (dispatch, ext_dispatch):
+        table[:] = [None] * 256
+    for table in (has_store_var, has_branch_var, ext_has_store_var, ext_has_branch_var):
+        table[:] = [False] * 256
+    setup_compat(env, [vars(ops_impl), globals()])
+
+
     op(1,   je,                         bvar=True)
     op(2,   jl,                         bvar=True)
     op(3,   jg,                         bvar=True)
@@ -299,7 +313,7 @@ def setup_opcodes(env):
     ext(3, art_shift, svar=True)
     ext(4, set_font, svar=True)
     ext(9, save_undo, svar=True)
-    # ext(10, restore_undo, svar=True) (NOT IMPLEMENTED)
+    ext(10, restore_undo, svar=True)
     ext(11, print_unicode)
     ext(12, check_unicode, svar=True)
     # ext(13, set_true_colour)
@@ -0,0 +1,512 @@
+# ops_compile.py (as in this file compiles whole routines to python)
+#
+# an optional tier on top of the threaded engine. once a routine has
+# been called often enough, every inst reachable from its entry gets
+# decoded and the lot is turned into one python function: z locals
+# become python locals, and branches become assignments to pc, which
+# then walks a chain of 'if pc == X' checks (one per basic block, in
+# address order, so a forward branch just falls down the chain and a
+# backward one goes around the while loop).
+#
+# calls and returns go through handle_call/handle_return as usual,
+# and any op without an inline version here just runs its normal
+# handler, so the frame is always brought up to date before control
+# can leave compiled code. compiled entry points (the routine start,
+# and every return address inside it) go straight into env.icache.
+
+from zmath import to_signed_word
+from ops_impl import *
+from ops_decode import ends_routine, jump_target, successors
+
+import ops_decode
+import ops_impl
+
+MAX_ROUTINE_INSTS = 1500
+
+# ops that may leave the machine somewhere else entirely, frame and all
+# (see memo.py, undo.py), so compiled code hands back to the engine after
+leaves_compiled = set(['sread', 'aread', 'restore_undo'])
+
+class RoutineCompiler(object):
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.call_counts = {}
+        self.entries = {} # call_addr -> {pc: entry}, None if uncompilable
+        self.icache = None
+
+    def note_call(self, env, call_addr):
+        if self.icache is not env.icache:
+            # new cache (after a restart/restore), put our entries back in
+            self.icache = env.icache
+            for entries in self.entries.values():
+                if entries:
+                    self.icache.update(entries)
+
+        count = self.call_counts.get(call_addr, 0) + 1
+        self.call_counts[call_addr] = count
+        if count == self.threshold:
+            entries = compile_routine(env, call_addr)
+            self.entries[call_addr] = entries
+            if entries:
+                self.icache.update(entries)
+
+    def num_compiled(self):
+        return len([e for e in self.entries.values() if e])
+
+# returns {pc: (op, opinfo, next_pc)} for every inst reachable
+# from code_ptr, or None if the routine is too odd to compile
+def decode_routine(env, code_ptr):
+    insts = {}
+    todo = [code_ptr]
+    while todo:
+        pc = todo.pop()
+        if pc in insts:
+            continue
+        if pc < env.hdr.static_mem_base or len(insts) >= MAX_ROUTINE_INSTS:
+            return None
+        try:
+            insts[pc] = ops_decode.decode(env, pc)
+        except KeyError: # illegal opcode, we followed something bad
+            return None
+        todo.extend(successors(*insts[pc]))
+
+    # insts that overlap each other can't be laid out in order
+    pcs = sorted(insts)
+    for pc, next_pc in zip(pcs, pcs[1:]):
+        if insts[pc][2] > next_pc:
+            return None
+    return insts
+
+def compile_routine(env, call_addr):
+    local_vars, code_ptr = ops_impl.parse_call_header(env, call_addr)
+    insts = decode_routine(env, code_ptr)
+    if insts is None:
+        return None
+    comp = Compilation(env, call_addr, code_ptr, len(local_vars), insts)
+    try:
+        fn = comp.build()
+    except (CantCompile, SyntaxError): # the interpreter can still run it
+        return None
+
+    entries = {}
+    for pc in [code_ptr] + sorted(comp.return_addrs):
+        entries[pc] = make_entry(fn, pc, insts[pc])
+    return entries
+
+def make_entry(fn, pc, inst):
+    def entry(env):
+        return fn(env, pc)
+    entry.op, entry.opinfo, entry.next_pc = inst
+    return entry
+
+class CantCompile(Exception):
+    pass
+
+# a few helpers the generated code leans on
+def zdiv(a, b):
+    a, b = to_signed_word(a), to_signed_word(b)
+    result = abs(a) // abs(b)
+    if (a < 0) + (b < 0) == 1:
+        result = -result
+    return result & 0xffff
+
+def zmod(a, b):
+    a, b = to_signed_word(a), to_signed_word(b)
+    result = abs(a) % abs(b)
+    if a < 0:
+        result = -result
+    return result & 0xffff
+
+class Compilation(object):
+    def __init__(self, env, call_addr, code_ptr, num_locals, insts):
+        self.env = env
+        self.call_addr = call_addr
+        self.num_locals = num_locals
+        self.insts = insts
+        self.pcs = sorted(insts)
+        self.global_base = env.hdr.global_var_base
+        self.consts = []
+        self.return_addrs = set()
+        self.assigned_locals = set()
+        self.used_locals = set()
+        self.block_starts = set([code_ptr])
+
+    def const(self, val):
+        self.consts.append(val)
+        return 'k%d' % (len(self.consts) - 1)
+
+    # var reads/writes
+
+    def local_name(self, var_num):
+        if var_num > self.num_locals:
+            raise CantCompile()
+        self.used_locals.add(var_num)
+        return 'L%d' % var_num
+
+    def global_addr(self, var_num):
+        return self.global_base + 2*(var_num - 16)
+
+    def read_var(self, var_num, pop=True):
+        if var_num == 0:
+            return 'stack.pop()' if pop else 'stack[-1]'
+        elif var_num < 16:
+            return self.local_name(var_num)
+        addr = self.global_addr(var_num)
+        return '(mem[%d] << 8 | mem[%d])' % (addr, addr+1)
+
+    def write_var(self, var_num, expr, push=True):
+        if var_num == 0:
+            if push:
+                return ['stack.append(%s)' % expr]
+            return ['stack[-1] = %s' % expr]
+        elif var_num < 16:
+            self.assigned_locals.add(var_num)
+            return ['%s = %s' % (self.local_name(var_num), expr)]
+        return ['write16(%d, %s)' % (self.global_addr(var_num), expr)]
+
+    # operand reads, each evaluated exactly once, in order
+
+    def operand_srcs(self, opinfo):
+        srcs = [('const', val) for val in opinfo.operands]
+        for i, var_num in opinfo.var_op_info:
+            srcs[i] = ('var', var_num)
+        return srcs
+
+    def operand(self, src, signed=False):
+        kind, val = src
+        if kind == 'const':
+            return str(to_signed_word(val) if signed else val)
+        expr = self.read_var(val)
+        return 's(%s)' % expr if signed else expr
+
+    # pulls every operand into a temp (a0, a1, ...) so they can be
+    # used more than once or out of order
+    def operand_temps(self, opinfo, signed=()):
+        lines, names = [], []
+        for i, src in enumerate(self.operand_srcs(opinfo)):
+            expr = self.operand(src, i in signed)
+            if src[0] == 'const':
+                names.append(expr)
+            else:
+                lines.append('a%d = %s' % (i, expr))
+                names.append('a%d' % i)
+        return lines, names
+
+    def const_var_num(self, opinfo):
+        # for ops whose first operand names a var
+        if 0 in [i for i, var_num in opinfo.var_op_info]:
+            raise CantCompile()
+        return opinfo.operands[0]
+
+    # control flow
+
+    def branch(self, cond, opinfo, next_pc):
+        self.sets_pc = True
+        if not opinfo.branch_on:
+            cond = 'not (%s)' % cond
+        offset = opinfo.branch_offset
+        lines = ['if %s:' % cond]
+        if offset == 0 or offset == 1:
+            lines += ['    handle_return(env, %d)' % offset,
+                      '    return env.pc']
+        else:
+            target = opinfo.branch_to
+            self.block_starts.add(target)
+            lines += ['    pc = %d' % target]
+            lines += ['else:',
+                      '    pc = %d' % next_pc]
+            self.block_starts.add(next_pc)
+            return lines
+        lines += ['pc = %d' % next_pc]
+        self.block_starts.add(next_pc)
+        return lines
+
+    def ret(self, expr):
+        self.sets_pc = True
+        self.block_starts.add(self.next_pc)
+        return ['handle_return(env, %s)' % expr, 'return env.pc']
+
+    def spill(self):
+        return ['stack[fp + %d] = L%d' % (n-1, n) for n in sorted(self.assigned_locals)]
+
+    def reload(self):
+        return ['L%d = stack[fp + %d]' % (n, n-1) for n in sorted(self.used_locals)]
+
+    def call(self, opinfo, next_pc, store_var):
+        lines, names = self.operand_temps(opinfo)
+        self.sets_pc = True
+        self.return_addrs.add(next_pc)
+        self.block_starts.add(next_pc)
+        return lines + [SPILL,
+                        'env.pc = %d' % next_pc,
+                        'handle_call(env, %s, [%s], %r)' % (names[0], ', '.join(names[1:]), store_var),
+                        'return env.pc']
+
+    def generic(self, op, opinfo, next_pc):
+        self.sets_pc = True
+        lines = [SPILL, 'env.pc = %d' % next_pc]
+        if opinfo.has_dynamic_operands:
+            lines += ['%s.operands = %s(env)' % (self.const(opinfo), self.const(opinfo.fetch_operands))]
+        lines += ['%s(env, %s)' % (self.const(op), self.const(opinfo)),
+                  'pc = env.pc']
+        targets = [next_pc]
+        if op.__name__ not in ends_routine and op.__name__ not in leaves_compiled:
+            target = opinfo.branch_to
+            if target is not None:
+                targets.append(target)
+                self.block_starts.add(next_pc)
+                self.block_starts.add(target)
+        else:
+            targets = []
+            self.block_starts.add(next_pc)
+        if targets:
+            lines += ['if %s:' % ' and '.join('pc != %d' % t for t in targets),
+                      '    return pc']
+        else:
+            lines += ['return pc']
+        return lines + [RELOAD]
+
+    def inst_lines(self, pc):
+        op, opinfo, next_pc = self.insts[pc]
+        name = op.__name__
+        emit = getattr(self, 'op_'+name, None)
+        self.sets_pc = False
+        self.next_pc = next_pc
+        if emit:
+            try:
+                return emit(opinfo, next_pc)
+            except CantCompile: # e.g. a var in an odd spot, let the handler do it
+                pass
+        return self.generic(op, opinfo, next_pc)
+
+    # inline ops
+
+    def store(self, opinfo, expr):
+        return self.write_var(opinfo.store_var, expr)
+
+    def arith(self, opinfo, fmt):
+        srcs = self.operand_srcs(opinfo)
+        a, b = self.operand(srcs[0]), self.operand(srcs[1])
+        return self.store(opinfo, fmt % (a, b))
+
+    def op_add(self, opinfo, next_pc):
+        return self.arith(opinfo, '(%s + %s) & 0xffff')
+    def op_sub(self, opinfo, next_pc):
+        return self.arith(opinfo, '(%s - %s) & 0xffff')
+    def op_mul(self, opinfo, next_pc):
+        return self.arith(opinfo, '(%s * %s) & 0xffff')
+    def op_div(self, opinfo, next_pc):
+        return self.arith(opinfo, 'zdiv(%s, %s)')
+    def op_mod(self, opinfo, next_pc):
+        return self.arith(opinfo, 'zmod(%s, %s)')
+
+    def bitwise(self, opinfo, sep):
+        srcs = self.operand_srcs(opinfo)
+        return self.store(opinfo, '(%s)' % sep.join(self.operand(src) for src in srcs))
+    def op_and_(self, opinfo, next_pc):
+        return self.bitwise(opinfo, ' & ')
+    def op_or_(self, opinfo, next_pc):
+        return self.bitwise(opinfo, ' | ')
+    def op_not_(self, opinfo, next_pc):
+        return self.store(opinfo, '~%s & 0xffff' % self.operand(self.operand_srcs(opinfo)[0]))
+
+    def op_load(self, opinfo, next_pc):
+        var_num = self.const_var_num(opinfo)
+        return self.store(opinfo, self.read_var(var_num, pop=False))
+
+    def op_store(self, opinfo, next_pc):
+        var_num = self.const_var_num(opinfo)
+        val = self.operand(self.operand_srcs(opinfo)[1])
+        return ['t = %s' % val] + self.write_var(var_num, 't', push=False)
+
+    def op_push(self, opinfo, next_pc):
+        return ['stack.append(%s)' % self.operand(self.operand_srcs(opinfo)[0])]
+
+    def op_nop(self, opinfo, next_pc):
+        return []
+
+    def incdec(self, opinfo, delta, chk=None):
+        var_num = self.const_var_num(opinfo)
+        lines = []
+        if chk:
+            lines += ['c = %s' % self.operand(self.operand_srcs(opinfo)[1], signed=True)]
+        lines += ['t = (%s %s 1) & 0xffff' % (self.read_var(var_num, pop=False), delta)]
+        lines += self.write_var(var_num, 't', push=False)
+        return lines
+
+    def op_inc(self, opinfo, next_pc):
+        return self.incdec(opinfo, '+')
+    def op_dec(self, opinfo, next_pc):
+        return self.incdec(opinfo, '-')
+    def op_inc_chk(self, opinfo, next_pc):
+        return self.incdec(opinfo, '+', chk=True) + self.branch('s(t) > c', opinfo, next_pc)
+    def op_dec_chk(self, opinfo, next_pc):
+        return self.incdec(opinfo, '-', chk=True) + self.branch('s(t) < c', opinfo, next_pc)
+
+    def op_jz(self, opinfo, next_pc):
+        a = self.operand(self.operand_srcs(opinfo)[0])
+        return self.branch('%s == 0' % a, opinfo, next_pc)
+
+    def op_je(self, opinfo, next_pc):
+        if len(opinfo.operands) == 2:
+            srcs = self.operand_srcs(opinfo)
+            cond = '%s == %s' % (self.operand(srcs[0]), self.operand(srcs[1]))
+            return self.branch(cond, opinfo, next_pc)
+        lines, names = self.operand_temps(opinfo)
+        # with one operand there's nothing to match, as in ops_impl.je
+        cond = ' or '.join('%s == %s' % (names[0], n) for n in names[1:]) or 'False'
+        return lines + self.branch(cond, opinfo, next_pc)
+
+    def op_jl(self, opinfo, next_pc):
+        srcs = self.operand_srcs(opinfo)
+        cond = '%s < %s' % (self.operand(srcs[0], True), self.operand(srcs[1], True))
+        return self.branch(cond, opinfo, next_pc)
+
+    def op_jg(self, opinfo, next_pc):
+        srcs = self.operand_srcs(opinfo)
+        cond = '%s > %s' % (self.operand(srcs[0], True), self.operand(srcs[1], True))
+        return self.branch(cond, opinfo, next_pc)
+
+    def op_test(self, opinfo, next_pc):
+        lines, names = self.operand_temps(opinfo)
+        return lines + self.branch('%s & %s == %s' % (names[0], names[1], names[1]), opinfo, next_pc)
+
+    def op_jin(self, opinfo, next_pc):
+        srcs = self.operand_srcs(opinfo)
+        cond = 'get_parent_num(env, %s) == %s' % (self.operand(srcs[0]), self.operand(srcs[1]))
+        return self.branch(cond, opinfo, next_pc)
+
+    def op_test_attr(self, opinfo, next_pc):
+        lines, names = self.operand_temps(opinfo)
+        obj, attr = names
+        cond = '%s and mem[get_obj_addr(env, %s) + %s // 8] >> (7 - %s %% 8) & 1' % (obj, obj, attr, attr)
+        return lines + self.branch(cond, opinfo, next_pc)
+
+    def op_get_parent(self, opinfo, next_pc):
+        a = self.operand(self.operand_srcs(opinfo)[0])
+        return self.store(opinfo, 'get_parent_num(env, %s)' % a)
+
+    def relative(self, opinfo, next_pc, getter):
+        a = self.operand(self.operand_srcs(opinfo)[0])
+        lines = ['t = %s(env, %s)' % (getter, a)]
+        lines += self.store(opinfo, 't')
+        return lines + self.branch('t != 0', opinfo, next_pc)
+
+    def op_get_child(self, opinfo, next_pc):
+        return self.relative(opinfo, next_pc, 'get_child_num')
+    def op_get_sibling(self, opinfo, next_pc):
+        return self.relative(opinfo, next_pc, 'get_sibling_num')
+
+    def op_loadw(self, opinfo, next_pc):
+        srcs = self.operand_srcs(opinfo)
+        lines = ['w = (%s + 2*%s) & 0xffff' % (self.operand(srcs[0]), self.operand(srcs[1], True))]
+        return lines + self.store(opinfo, 'mem[w] << 8 | mem[w+1]')
+
+    def op_loadb(self, opinfo, next_pc):
+        srcs = self.operand_srcs(opinfo)
+        addr = '(%s + %s) & 0xffff' % (self.operand(srcs[0]), self.operand(srcs[1], True))
+        return self.store(opinfo, 'mem[%s]' % addr)
+
+    def op_storew(self, opinfo, next_pc):
+        srcs = self.operand_srcs(opinfo)
+        addr = '(%s + 2*%s) & 0xffff' % (self.operand(srcs[0]), self.operand(srcs[1], True))
+        return ['write16(%s, %s)' % (addr, self.operand(srcs[2]))]
+
+    def op_storeb(self, opinfo, next_pc):
+        srcs = self.operand_srcs(opinfo)
+        addr = '(%s + %s) & 0xffff' % (self.operand(srcs[0]), self.operand(srcs[1], True))
+        return ['write8(%s, %s & 0xff)' % (addr, self.operand(srcs[2]))]
+
+    def op_jump(self, opinfo, next_pc):
+        target = jump_target(opinfo, next_pc)
+        if target is None:
+            raise CantCompile()
+        self.sets_pc = True
+        self.block_starts.add(target)
+        self.block_starts.add(next_pc)
+        return ['pc = %d' % target]
+
+    def op_rtrue(self, opinfo, next_pc):
+        return self.ret('1')
+    def op_rfalse(self, opinfo, next_pc):
+        return self.ret('0')
+    def op_ret(self, opinfo, next_pc):
+        return self.ret(self.operand(self.operand_srcs(opinfo)[0]))
+    def op_ret_popped(self, opinfo, next_pc):
+        return self.ret('stack.pop()')
+
+    def op_check_arg_count(self, opinfo, next_pc):
+        a = self.operand(self.operand_srcs(opinfo)[0])
+        return self.branch('stack[fp + %d] >= %s' % (FP_NUM_ARGS, a), opinfo, next_pc)
+
+    def op_call(self, opinfo, next_pc):
+        return self.call(opinfo, next_pc, opinfo.store_var)
+    def op_call_2s(self, opinfo, next_pc):
+        return self.call(opinfo, next_pc, opinfo.store_var)
+    def op_call_1s(self, opinfo, next_pc):
+        return self.call(opinfo, next_pc, opinfo.store_var)
+    def op_call_2n(self, opinfo, next_pc):
+        return self.call(opinfo, next_pc, None)
+    def op_call_1n(self, opinfo, next_pc):
+        return self.call(opinfo, next_pc, None)
+    def op_call_vn(self, opinfo, next_pc):
+        return self.call(opinfo, next_pc, None)
+
+    # putting it together
+
+    def build(self):
+        body = []
+        for pc in self.pcs:
+            inst_lines = self.inst_lines(pc)
+            body.append((pc, inst_lines, self.sets_pc))
+
+        lines = []
+        lines.append('def routine_%x(env, pc):' % self.call_addr)
+        lines.append('    if env.mem_share is not None:')
+        lines.append('        env.own_mem()')
+        lines.append('    stack, fp, mem = env.stack, env.fp, env.mem')
+        lines.append('    write8, write16 = env.write8, env.write16')
+        for line in self.reload():
+            lines.append('    ' + line)
+        lines.append('    while True:')
+        # locals are clean (same as on the stack) right after a spill or reload,
+        # so a spill there can be skipped
+        clean = False
+        for i, (pc, inst_lines, sets_pc) in enumerate(body):
+            if pc in self.block_starts:
+                lines.append('        if pc == %d:' % pc)
+                clean = False
+            for line in inst_lines:
+                if line is SPILL:
+                    if not clean:
+                        lines += ['            ' + l for l in self.spill()]
+                    clean = True
+                elif line is RELOAD:
+                    lines += ['            ' + l for l in self.reload()]
+                    clean = True
+                else:
+                    lines.append('            ' + line)
+                    if line.startswith('L'):
+                        clean = False
+            # fall into the next block
+            next_pc = self.insts[pc][2]
+            if i+1 < len(body) and body[i+1][0] in self.block_starts and not sets_pc:
+                lines.append('            pc = %d' % next_pc)
+        lines.append('    return pc')
+
+        # one arg unpacked inside, since py2 defs take at most 255 args
+        src = 'def make(consts):\n'
+        if self.consts:
+            src += '    %s, = consts\n' % ', '.join('k%d' % i for i in xrange(len(self.consts)))
+        src += '\n'.join('    ' + line for line in lines)
+        src += '\n    return routine_%x\n' % self.call_addr
+
+        namespace = dict(globals())
+        namespace.update(vars(ops_impl)) # the helpers as bound for this story
+        namespace['s'] = to_signed_word
+        code = compile(src, '<routine %s>' % hex(self.call_addr), 'exec')
+        exec(code, namespace)
+        return namespace['make'](self.consts)
+
+SPILL = object()
+RELOAD = object()
@@ -1,7 +1,8 @@
-from debug import DBG, warn, err
+from debug import warn, err
 from zmath import to_signed_word
 
 import ops
+import idioms
 
 class VarForm:
     pass
@@ -66,27 +67,190 @@ def get_operand_sizes(szbyte):
         offset -= 2
     return sizes
 
-class OpInfo:
+class OpInfo(object):
+    __slots__ = ['pc', 'opcode', 'is_extended', 'store_var', 'branch_offset',
+                 'branch_on', 'text', 'store_ptr', 'branch_ptr',
+                 'operands', 'var_op_info', 'has_dynamic_operands',
+                 'fetch_operands', 'store', 'branch', 'branch_to',
+                 'var_get', 'var_set']
+
     def __init__(self, operands, var_op_info):
 
+        self.pc = None # for debug/tools
         self.opcode = None # for debug/tools
         self.is_extended = False # for debug/tools
         self.store_var = None
         self.branch_offset = None
         self.branch_on = None
         self.text = None
-        self.last_pc_branch_var = None
-        self.last_pc_store_var = None
+        self.store_ptr = None # addr of the store byte, for quetzal (v4+)
+        self.branch_ptr = None # addr of the first branch byte, for quetzal (v3)
 
         self.operands = operands
         self.var_op_info = var_op_info
         self.has_dynamic_operands = len(var_op_info) > 0
+        self.fetch_operands = None # set by decode() if has_dynamic_operands
 
-    def fixup_dynamic_operands(self, env):
-        for i, var_num in self.var_op_info:
-            self.operands[i] = ops.get_var(env, var_num)
+        # also set by decode(), with the var/offset already resolved
+        self.store = None # store(env, val)
+        self.branch = None # branch(env), jumps or returns
+        self.branch_to = None # absolute target pc, None if branch returns
+        self.var_get = None # var_get(env) and var_set(env, val) for ops
+        self.var_set = None # whose first operand names a var (inc, dec...)
 
-def decode(env, pc):
+# operands (by index) that ops want as signed words. decode()
+# converts these ahead of time (constants once, vars as they're
+# fetched), so the ops themselves never call to_signed_word.
+signed_operands = {
+    'add': (0, 1),
+    'sub': (0, 1),
+    'mul': (0, 1),
+    'div': (0, 1),
+    'mod': (0, 1),
+    'jl': (0, 1),
+    'jg': (0, 1),
+    'jump': (0,),
+    'loadw': (1,),
+    'loadb': (1,),
+    'storew': (1,),
+    'storeb': (1,),
+    'inc_chk': (1,),
+    'dec_chk': (1,),
+    'random_': (0,),
+    'print_num': (0,),
+    'output_stream': (0,),
+    'log_shift': (1,),
+    'art_shift': (0, 1),
+    'copy_table': (2,),
+    'erase_window': (0,),
+    'set_cursor': (0, 1),
+}
+
+# a getter for one var operand, with the stack/local/global
+# choice (and sign conversion, if any) made once, here
+def make_var_getter(env, var_num, signed):
+    if var_num == 0:
+        if signed:
+            def get(env):
+                return to_signed_word(env.stack.pop())
+        else:
+            def get(env):
+                return env.stack.pop()
+    elif var_num < 16:
+        i = var_num - 1
+        if signed:
+            def get(env):
+                return to_signed_word(env.stack[env.fp + i])
+        else:
+            def get(env):
+                return env.stack[env.fp + i]
+    else:
+        addr = env.global_var_base + 2*(var_num - 16)
+        if signed:
+            def get(env):
+                mem = env.mem
+                return to_signed_word(mem[addr] << 8 | mem[addr+1])
+        else:
+            def get(env):
+                mem = env.mem
+                return mem[addr] << 8 | mem[addr+1]
+    return get
+
+# the store side of make_var_getter, masking like set_var does
+def make_var_setter(env, var_num):
+    if var_num == 0:
+        def setter(env, val):
+            env.stack.append(val & 0xffff)
+    elif var_num < 16:
+        i = var_num - 1
+        def setter(env, val):
+            env.stack[env.fp + i] = val & 0xffff
+    else:
+        addr = env.global_var_base + 2*(var_num - 16)
+        if 0x36 < addr < env.dyn_word_end:
+            # (the stamps and watch are looked up each time, as insts
+            # are shared with clones, see Env.clone)
+            shift = env.watch.PAGE_SHIFT
+            page0, page1 = addr >> shift, (addr+1) >> shift
+            def setter(env, val):
+                if env.mem_share is not None:
+                    env.own_mem()
+                mem = env.mem
+                mem[addr] = (val >> 8) & 0xff
+                mem[addr+1] = val & 0xff
+                stamps = env.page_stamps
+                stamps[page0] = stamps[page1] = env.epoch
+                pages = env.watched_pages
+                if pages[page0] or pages[page1]:
+                    env.watch.notify(addr, addr+2)
+        else:
+            def setter(env, val): # let write16 complain about it
+                env.write16(addr, val & 0xffff)
+    return setter
+
+def make_branch(offset, next_pc):
+    if offset == 0 or offset == 1:
+        def branch(env):
+            ops.handle_return(env, offset)
+        return branch, None
+    target = next_pc + offset - 2
+    def branch(env):
+        env.pc = target
+    return branch, target
+
+# ops whose first operand is a var number, read then written back
+# (so for the stack, the value is replaced in place)
+var_ref_ops = set(['inc', 'dec', 'inc_chk', 'dec_chk'])
+
+def make_var_ref(env, opinfo):
+    if opinfo.var_op_info and opinfo.var_op_info[0][0] == 0:
+        # which var is only known at run time
+        def var_get(env):
+            return to_signed_word(ops.get_var(env, opinfo.operands[0]))
+        def var_set(env, val):
+            ops.set_var(env, opinfo.operands[0], val)
+        return var_get, var_set
+    var_num = opinfo.operands[0]
+    return make_var_getter(env, var_num, True), make_var_setter(env, var_num)
+
+# returns a fresh operand list each time it's called: the constants
+# are already in place, vars are fetched in operand order (that
+# matters when more than one comes off the stack)
+def make_operand_fetcher(env, operands, var_op_info, signed):
+    getters = [(i, make_var_getter(env, var_num, i in signed)) for i, var_num in var_op_info]
+
+    if len(getters) == len(operands) == 1:
+        (i0, g0), = getters
+        def fetch(env):
+            return [g0(env)]
+    elif len(getters) == len(operands) == 2:
+        (i0, g0), (i1, g1) = getters
+        def fetch(env):
+            return [g0(env), g1(env)]
+    elif len(getters) == 1:
+        (i0, g0), = getters
+        def fetch(env):
+            fetched = operands[:]
+            fetched[i0] = g0(env)
+            return fetched
+    elif len(getters) == 2:
+        (i0, g0), (i1, g1) = getters
+        def fetch(env):
+            fetched = operands[:]
+            fetched[i0] = g0(env)
+            fetched[i1] = g1(env)
+            return fetched
+    else:
+        def fetch(env):
+            fetched = operands[:]
+            for i, get in getters:
+                fetched[i] = get(env)
+            return fetched
+    return fetch
+
+# the byte-level half of decode(): everything about the inst that can
+# be read off the story, as plain values (see decode_cache.py)
+def decode_fields(env, pc):
 
     opcode = env.u8(pc)
     form = get_opcode_form(env, opcode)
@@ -135,7 +299,7 @@ def decode(env, pc):
             operands.append(env.u8(operand_ptr))
             operand_ptr += 1
         elif size == VarSize:
-            operands.append(None) #this is fixedup after every load from icache by opinfo method
+            operands.append(None) # filled in on each run by opinfo.fetch_operands
             var_num = env.u8(operand_ptr)
             var_op_info.append( (i,var_num) )
             operand_ptr += 1
@@ -151,23 +315,23 @@ def decode(env, pc):
         has_store_var = ops.has_store_var
         has_branch_var = ops.has_branch_var
 
-    opinfo = OpInfo(operands, var_op_info)
-
-    opinfo.opcode = opcode
-    opinfo.is_extended = form == ExtForm
+    if dispatch[opcode] is None:
+        raise KeyError(opcode) # not an op in this version
 
+    store_var = store_ptr = None
     if has_store_var[opcode]:
-        opinfo.store_var = env.u8(operand_ptr)
-        opinfo.last_pc_store_var = operand_ptr # to make quetzal saves easier
+        store_var = env.u8(operand_ptr)
+        store_ptr = operand_ptr
         operand_ptr += 1
 
+    branch_on = branch_offset = branch_ptr = None
     if has_branch_var[opcode]: # std:4.7
         branch_info = env.u8(operand_ptr)
-        opinfo.last_pc_branch_var = operand_ptr # to make quetzal saves easier
+        branch_ptr = operand_ptr
         operand_ptr += 1
-        opinfo.branch_on = (branch_info & 128) == 128
+        branch_on = (branch_info & 128) == 128
         if branch_info & 64:
-            opinfo.branch_offset = branch_info & 0x3f
+            branch_offset = branch_info & 0x3f
         else:
             branch_offset = branch_info & 0x3f
             branch_offset <<= 8
@@ -176,7 +340,7 @@ def decode(env, pc):
             # sign extend 14b # to 16b
             if branch_offset & 0x2000:
                 branch_offset |= 0xc000
-            opinfo.branch_offset = to_signed_word(branch_offset)
+            branch_offset = to_signed_word(branch_offset)
 
     # handle print_ and print_ret's string operand
     if form != ExtForm and opcode in (178, 179):
@@ -190,24 +354,155 @@ def decode(env, pc):
     # After all that, operand_ptr should point to the next opcode
     next_pc = operand_ptr
 
-    if DBG:
-        def hex_out(bytes):
-            s = ''
-            for b in bytes:
-                s += hex(b) + ' '
-            return s
-        op_hex = hex_out(env.mem[pc:next_pc])
-
-        warn('decode: pc', hex(pc))
-        warn('      opcode', opcode)
-        warn('      form', form)
-        warn('      count', count)
-        if opinfo.store_var:
-            warn('      store_var', ops.get_var_name(opinfo.store_var))
-        warn('      sizes', sizes)
-        warn('      operands', opinfo.operands)
-        warn('      next_pc', hex(next_pc))
-        #warn('      bytes', op_hex)
-
-    return dispatch[opcode], opinfo, next_pc
+    return (form == ExtForm, opcode, operands, var_op_info, store_var,
+            store_ptr, branch_on, branch_offset, branch_ptr, next_pc)
+
+def decode(env, pc):
+    known = env.decoded_fields
+    if known is not None and pc >= env.static_mem_base:
+        fields = known.get(pc)
+        if fields is None:
+            fields = known[pc] = decode_fields(env, pc)
+    else:
+        fields = decode_fields(env, pc)
+    (is_extended, opcode, operands, var_op_info, store_var,
+     store_ptr, branch_on, branch_offset, branch_ptr, next_pc) = fields
+    operands = list(operands) # the fields may be shared, this gets signed below
+
+    if is_extended:
+        dispatch = ops.ext_dispatch
+    else:
+        dispatch = ops.dispatch
+
+    opinfo = OpInfo(operands, var_op_info)
+
+    opinfo.pc = pc
+    opinfo.opcode = opcode
+    opinfo.is_extended = is_extended
+    opinfo.store_var = store_var
+    opinfo.store_ptr = store_ptr
+    opinfo.branch_on = branch_on
+    opinfo.branch_offset = branch_offset
+    opinfo.branch_ptr = branch_ptr
+
+    op = dispatch[opcode]
+    signed = signed_operands.get(op.__name__, ())
+    for i in signed:
+        if i < len(operands) and operands[i] is not None:
+            operands[i] = to_signed_word(operands[i])
+    if opinfo.has_dynamic_operands:
+        opinfo.fetch_operands = make_operand_fetcher(env, operands, var_op_info, signed)
+    if opinfo.store_var is not None:
+        opinfo.store = make_var_setter(env, opinfo.store_var)
+    if opinfo.branch_offset is not None:
+        opinfo.branch, opinfo.branch_to = make_branch(opinfo.branch_offset, next_pc)
+    if op.__name__ in var_ref_ops:
+        opinfo.var_get, opinfo.var_set = make_var_ref(env, opinfo)
+
+    return op, opinfo, next_pc
+
+# static control flow, for tools that walk code without running it
+
+# ops that leave the routine for good
+ends_routine = set(['ret', 'rtrue', 'rfalse', 'ret_popped', 'print_ret',
+                    'quit', 'restart', 'throw'])
+
+call_ops = set(['call', 'call_2s', 'call_2n', 'call_1s', 'call_1n', 'call_vn'])
+
+def jump_target(opinfo, next_pc):
+    if opinfo.has_dynamic_operands:
+        return None
+    return next_pc + opinfo.operands[0] - 2
+
+# pcs that can run right after this inst in the same routine
+# (a jump through a var has none we can know of)
+def successors(op, opinfo, next_pc):
+    name = op.__name__
+    if name in ends_routine:
+        return []
+    if name == 'jump':
+        target = jump_target(opinfo, next_pc)
+        return [target] if target is not None else []
+    succ = [next_pc]
+    target = opinfo.branch_to
+    if target is not None:
+        succ.append(target)
+    return succ
+
+# superinstructions: op pairs fused at decode time so the second op
+# runs without a trip back through the dispatch loop. keys are op
+# names (first, second), '*' matching any second op. values say
+# where second sits: 'next' is the fall-through inst, 'branch' is
+# the target of first's branch ('next' only makes sense for ops
+# that can fall through). tune from zenv.run_pair_report().
+# FUSE also turns on the whole-loop insts from idioms.py.
+FUSE = True
+MAX_FUSED = 3
+fused_pairs = {
+    ('je', 'jump'): 'next',
+    ('jz', 'jump'): 'next',
+    ('loadw', 'store'): 'next',
+    ('inc_chk', '*'): 'branch',
+    ('dec_chk', '*'): 'branch',
+}
+
+def get_fused_pos(first_name, second_name):
+    if (first_name, second_name) in fused_pairs:
+        return fused_pairs[first_name, second_name]
+    return fused_pairs.get((first_name, '*'))
+
+# threaded code: each decoded instruction becomes a closure that
+# fetches its own operands, runs its op, and returns the next pc.
+# op/opinfo/next_pc ride along as attributes for step() and tools.
+def make_inst(env, pc, fuse_depth=1):
+    op, opinfo, next_pc = decode(env, pc)
+
+    if opinfo.has_dynamic_operands:
+        fetch = opinfo.fetch_operands
+        def inst(env):
+            env.pc = next_pc
+            opinfo.operands = fetch(env)
+            op(env, opinfo)
+            return env.pc
+    else:
+        def inst(env):
+            env.pc = next_pc
+            op(env, opinfo)
+            return env.pc
+
+    inst.op, inst.opinfo, inst.next_pc = op, opinfo, next_pc
+
+    if FUSE and pc >= env.static_mem_base:
+        if fuse_depth < MAX_FUSED:
+            inst = fuse(env, inst, fuse_depth)
+        # even as a fused second: inc_chk's back edge is one
+        inst = idioms.whole_loop(env, pc, inst)
+    return inst
+
+def fuse(env, first, fuse_depth):
+    name = first.op.__name__
+    wheres = set(where for (first_name, second_name), where in fused_pairs.items()
+                 if first_name == name)
+    for where in sorted(wheres):
+        second_pc = pc_to_fuse(first, where)
+        if second_pc is None or second_pc < env.static_mem_base:
+            continue
+        second = make_inst(env, second_pc, fuse_depth+1)
+        if get_fused_pos(name, second.op.__name__) == where:
+            return make_fused(first, second, second_pc)
+    return first
+
+def pc_to_fuse(inst, where):
+    if where == 'next':
+        return inst.next_pc
+    return inst.opinfo.branch_to # None if no branch, or branch is a return
 
+def make_fused(first, second, second_pc):
+    def inst(env):
+        pc = first(env)
+        if pc == second_pc:
+            return second(env)
+        return pc
+    # step() only ever runs the first op
+    inst.op, inst.opinfo, inst.next_pc = first.op, first.opinfo, first.next_pc
+    return inst
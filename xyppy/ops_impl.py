@@ -5,7 +5,7 @@
 
 import random
 
-from debug import DBG, warn, err
+from debug import warn, err
 from zmath import to_signed_word
 
 from ops_impl_compat import *
@@ -14,18 +14,16 @@ import quetzal
 
 def get_var(env, var_num, pop_stack=True):
     if var_num == 0:
-        frame = env.callstack[-1]
         if pop_stack:
-            return frame.stack.pop()
+            return env.stack.pop()
         else:
-            return frame.stack[-1]
+            return env.stack[-1]
     elif var_num < 16:
-        frame = env.callstack[-1]
-        return frame.locals[var_num - 1]
+        return env.stack[env.fp + var_num - 1]
     elif var_num < 256:
-        g_idx = var_num - 16
-        g_base = env.hdr.global_var_base
-        return env.u16(g_base + 2*g_idx)
+        addr = env.global_var_base + 2*(var_num - 16)
+        mem = env.mem
+        return mem[addr] << 8 | mem[addr+1]
     else:
         err('illegal var num: '+str(var_num))
 
@@ -33,18 +31,14 @@ def set_var(env, var_num, result, push_stack=True):
     result &= 0xffff
 
     if var_num == 0:
-        frame = env.callstack[-1]
         if push_stack:
-            frame.stack.append(result)
+            env.stack.append(result)
         else:
-            frame.stack[-1] = result
+            env.stack[-1] = result
     elif var_num < 16:
-        frame = env.callstack[-1]
-        frame.locals[var_num - 1] = result
+        env.stack[env.fp + var_num - 1] = result
     elif var_num < 256:
-        g_idx = var_num - 16
-        g_base = env.hdr.global_var_base
-        env.write16(g_base + 2*g_idx, result)
+        env.write16(env.global_var_base + 2*(var_num - 16), result)
     else:
         err('set_var: illegal var_num: '+str(var_num))
 
@@ -57,50 +51,50 @@ def get_var_name(var_num):
         return 'G'+hex(var_num-16)[2:].zfill(2)
 
 def add(env, opinfo):
-    a = to_signed_word(opinfo.operands[0])
-    b = to_signed_word(opinfo.operands[1])
+    a = opinfo.operands[0]
+    b = opinfo.operands[1]
     result = a+b
-    set_var(env, opinfo.store_var, result)
+    opinfo.store(env, result)
 
 def sub(env, opinfo):
-    a = to_signed_word(opinfo.operands[0])
-    b = to_signed_word(opinfo.operands[1])
+    a = opinfo.operands[0]
+    b = opinfo.operands[1]
     result = a-b
-    set_var(env, opinfo.store_var, result)
+    opinfo.store(env, result)
 
 def mul(env, opinfo):
-    a = to_signed_word(opinfo.operands[0])
-    b = to_signed_word(opinfo.operands[1])
+    a = opinfo.operands[0]
+    b = opinfo.operands[1]
     result = a*b
-    set_var(env, opinfo.store_var, result)
+    opinfo.store(env, result)
 
 def div(env, opinfo):
-    a = to_signed_word(opinfo.operands[0])
-    b = to_signed_word(opinfo.operands[1])
+    a = opinfo.operands[0]
+    b = opinfo.operands[1]
     num_neg = (a < 0) + (b < 0)
     result = abs(a) // abs(b)
     if num_neg == 1:
         result = -result
-    set_var(env, opinfo.store_var, result)
+    opinfo.store(env, result)
 
 def mod(env, opinfo):
-    a = to_signed_word(opinfo.operands[0])
-    b = to_signed_word(opinfo.operands[1])
+    a = opinfo.operands[0]
+    b = opinfo.operands[1]
     result = abs(a) % abs(b)
     if a < 0: # spec says a determines sign
         result = -result
-    set_var(env, opinfo.store_var, result)
+    opinfo.store(env, result)
 
 def load(env, opinfo):
     var = opinfo.operands[0]
     val = get_var(env, var, pop_stack=False)
-    set_var(env, opinfo.store_var, val)
+    opinfo.store(env, val)
 
 def jz(env, opinfo):
     result = opinfo.operands[0] == 0
 
     if result == opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
+        opinfo.branch(env)
 
 def je(env, opinfo):
     first = opinfo.operands[0]
@@ -111,53 +105,46 @@ def je(env, opinfo):
             break
 
     if result == opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
+        opinfo.branch(env)
 
 def jl(env, opinfo):
-    a = to_signed_word(opinfo.operands[0])
-    b = to_signed_word(opinfo.operands[1])
+    a = opinfo.operands[0]
+    b = opinfo.operands[1]
     result = a < b
 
     if result == opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
+        opinfo.branch(env)
 
 def jg(env, opinfo):
-    a = to_signed_word(opinfo.operands[0])
-    b = to_signed_word(opinfo.operands[1])
+    a = opinfo.operands[0]
+    b = opinfo.operands[1]
     result = a > b
 
     if result == opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
-
-def handle_branch(env, offset):
-    if offset == 0:
-        handle_return(env, 0)
-    elif offset == 1:
-        handle_return(env, 1)
-    else:
-        env.pc += offset - 2
+        opinfo.branch(env)
 
 def jump(env, opinfo):
-    offset = to_signed_word(opinfo.operands[0])
+    offset = opinfo.operands[0]
     env.pc += offset - 2
 
 def loadw(env, opinfo):
     array_addr = opinfo.operands[0]
-    word_index = to_signed_word(opinfo.operands[1])
+    word_index = opinfo.operands[1]
     word_loc = 0xffff & (array_addr + 2*word_index)
 
-    set_var(env, opinfo.store_var, env.u16(word_loc))
+    mem = env.mem
+    opinfo.store(env, mem[word_loc] << 8 | mem[word_loc+1])
 
 def loadb(env, opinfo):
     array_addr = opinfo.operands[0]
-    byte_index = to_signed_word(opinfo.operands[1])
+    byte_index = opinfo.operands[1]
     byte_loc = 0xffff & (array_addr + byte_index)
 
-    set_var(env, opinfo.store_var, env.u8(byte_loc)) 
+    opinfo.store(env, env.mem[byte_loc])
 
 def storeb(env, opinfo):
     array_addr = opinfo.operands[0]
-    byte_index = to_signed_word(opinfo.operands[1])
+    byte_index = opinfo.operands[1]
     val = opinfo.operands[2] & 0xff
     mem_loc = 0xffff & (array_addr + byte_index)
 
@@ -165,7 +152,7 @@ def storeb(env, opinfo):
 
 def storew(env, opinfo):
     array_addr = opinfo.operands[0]
-    word_index = to_signed_word(opinfo.operands[1])
+    word_index = opinfo.operands[1]
     val = opinfo.operands[2]
     word_loc = 0xffff & (array_addr + 2*word_index)
 
@@ -180,67 +167,47 @@ def and_(env, opinfo):
     acc = 0xffff
     for operand in opinfo.operands:
         acc &= operand
-    set_var(env, opinfo.store_var, acc)
+    opinfo.store(env, acc)
 
 def or_(env, opinfo):
     acc = 0
     for operand in opinfo.operands:
         acc |= operand
-    set_var(env, opinfo.store_var, acc)
+    opinfo.store(env, acc)
 
 def inc(env, opinfo):
     var_num = opinfo.operands[0]
-    var_val = to_signed_word(get_var(env, var_num))
-    var_val = var_val+1 & 0xffff
-    set_var(env, var_num, var_val)
-
-    if DBG:
-        warn('    var', get_var_name(var_num))
-        warn('    new_val', to_signed_word(var_val))
+    var_val = opinfo.var_get(env)+1 & 0xffff
+    opinfo.var_set(env, var_val)
 
 def dec(env, opinfo):
     var_num = opinfo.operands[0]
-    var_val = to_signed_word(get_var(env, var_num))
-    var_val = var_val-1 & 0xffff
-    set_var(env, var_num, var_val)
-
-    if DBG:
-        warn('    var_num', var_num)
-        warn('    new_val', to_signed_word(var_val))
+    var_val = opinfo.var_get(env)-1 & 0xffff
+    opinfo.var_set(env, var_val)
 
 def inc_chk(env, opinfo):
     var_loc = opinfo.operands[0]
-    chk_val = to_signed_word(opinfo.operands[1])
+    chk_val = opinfo.operands[1]
 
-    var_val = to_signed_word(get_var(env, var_loc))
-    var_val = var_val+1 & 0xffff
-    set_var(env, var_loc, var_val)
+    var_val = opinfo.var_get(env)+1 & 0xffff
+    opinfo.var_set(env, var_val)
 
     var_val = to_signed_word(var_val)
     result = var_val > chk_val
     if result == opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
-
-    if DBG:
-        warn('    var_loc', get_var_name(var_loc))
-        warn('    var_val', var_val)
+        opinfo.branch(env)
 
 def dec_chk(env, opinfo):
     var_loc = opinfo.operands[0]
-    chk_val = to_signed_word(opinfo.operands[1])
+    chk_val = opinfo.operands[1]
 
-    var_val = to_signed_word(get_var(env, var_loc))
-    var_val = var_val-1 & 0xffff
-    set_var(env, var_loc, var_val)
+    var_val = opinfo.var_get(env)-1 & 0xffff
+    opinfo.var_set(env, var_val)
 
     var_val = to_signed_word(var_val)
     result = var_val < chk_val
     if result == opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
-
-    if DBG:
-        warn('    var_loc', get_var_name(var_loc))
-        warn('    var_val', var_val)
+        opinfo.branch(env)
 
 def test(env, opinfo):
     bitmap = opinfo.operands[0]
@@ -248,28 +215,27 @@ def test(env, opinfo):
     result = bitmap & flags == flags
 
     if result == opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
-
-    if DBG:
-        warn('    bitmap', bin(bitmap))
-        warn('    flags', bin(flags))
+        opinfo.branch(env)
 
 def push(env, opinfo):
     value = opinfo.operands[0]
-    frame = env.callstack[-1]
-    frame.stack.append(value)
+    env.stack.append(value)
 
 def random_(env, opinfo):
-    rand_max = to_signed_word(opinfo.operands[0])
+    rand_max = opinfo.operands[0]
     if rand_max < 0:
         random.seed(rand_max)
+        env.rng_seeded = True
         result = 0
     elif rand_max == 0:
         random.seed()
+        env.rng_seeded = False
         result = 0
     else:
         result = random.randint(1, rand_max)
-    set_var(env, opinfo.store_var, result)
+    if env.memo and not env.rng_seeded:
+        env.memo.taint(env)
+    opinfo.store(env, result)
 
 def jin(env, opinfo):
     obj1 = opinfo.operands[0]
@@ -278,67 +244,45 @@ def jin(env, opinfo):
     result = get_parent_num(env, obj1) == obj2
 
     if result == opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
-
-    if DBG:
-        warn('    obj1', obj1, '(',get_obj_str(env,obj1),')')
-        warn('    obj2', obj2, '(',get_obj_str(env,obj2),')')
-        warn('    is_parent?', result)
+        opinfo.branch(env)
 
 def get_child(env, opinfo):
     obj = opinfo.operands[0]
 
     child_num = get_child_num(env, obj)
-    set_var(env, opinfo.store_var, child_num)
+    opinfo.store(env, child_num)
 
     result = child_num != 0
     if result == opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
-
-    if DBG:
-        warn('    obj', obj,'(',get_obj_str(env, obj),')')
-        warn('    child', child_num, '(',get_obj_str(env, child_num),')')
+        opinfo.branch(env)
 
 def get_sibling(env, opinfo):
     obj = opinfo.operands[0]
 
     sibling_num = get_sibling_num(env, obj)
-    set_var(env, opinfo.store_var, sibling_num)
+    opinfo.store(env, sibling_num)
 
     result = sibling_num != 0
     if result == opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
-
-    if DBG:
-        warn('    obj', obj,'(',get_obj_str(env, obj),')')
-        warn('    sibling', sibling_num, '(',get_obj_str(env, sibling_num),')')
+        opinfo.branch(env)
 
 def get_parent(env, opinfo):
     obj = opinfo.operands[0]
 
     parent_num = get_parent_num(env, obj)
-    set_var(env, opinfo.store_var, parent_num)
-
-    if DBG:
-        warn('    obj', obj,'(',get_obj_str(env, obj),')')
-        warn('    parent', parent_num, '(',get_obj_str(env, parent_num),')')
+    opinfo.store(env, parent_num)
 
 def handle_return(env, return_val):
-    frame = env.callstack.pop()
-    if len(env.callstack) == 0:
+    stack, fp = env.stack, env.fp
+    prev_fp = stack[fp-1]
+    if prev_fp == 0:
         err('returned from unreturnable/nonexistant function!')
-    if frame.return_val_loc != None:
-        set_var(env, frame.return_val_loc, return_val)
-    env.pc = frame.return_addr
-
-    if DBG:
-        warn('    helper: handle_return')
-        warn('        return_val', return_val)
-        if frame.return_val_loc:
-            warn('        return_val_loc', get_var_name(frame.return_val_loc))
-        else:
-            warn('        return_val_loc None')
-        warn('        return_addr', hex(frame.return_addr))
+    return_addr, return_val_loc = stack[fp-5], stack[fp-4]
+    del stack[fp-FRAME_SIZE:]
+    env.fp = prev_fp
+    if return_val_loc != None:
+        set_var(env, return_val_loc, return_val)
+    env.pc = return_addr
 
 def ret(env, opinfo):
     return_val = opinfo.operands[0]
@@ -351,8 +295,7 @@ def rfalse(env, opinfo):
     handle_return(env, 0)
 
 def ret_popped(env, opinfo):
-    frame = env.callstack[-1]
-    ret_val = frame.stack.pop()
+    ret_val = env.stack.pop()
     handle_return(env, ret_val)
 
 def quit(env, opinfo):
@@ -376,10 +319,6 @@ def _print_addr(env, addr):
     string = unpack_string(env, packed_string)
     write(env, string)
 
-    if DBG:
-        warn('    helper: _print_addr')
-        warn('            addr', addr)
-
 def print_addr(env, opinfo):
     addr = opinfo.operands[0]
     _print_addr(env, addr)
@@ -388,7 +327,7 @@ def new_line(env, opinfo):
     write(env, '\n')
 
 def print_num(env, opinfo):
-    num = to_signed_word(opinfo.operands[0])
+    num = opinfo.operands[0]
     write(env, str(num))
 
 def print_obj(env, opinfo):
@@ -396,9 +335,6 @@ def print_obj(env, opinfo):
     string = get_obj_str(env, obj)
     write(env, string)
 
-    if DBG:
-        warn('    obj', obj, '(', get_obj_str(env, obj), ')')
-
 def print_char(env, opinfo):
     char = zscii_to_ascii(env, [opinfo.operands[0]])
     write(env, char)
@@ -409,7 +345,7 @@ def get_prop_len(env, opinfo):
         size = 0
     else:
         size, num = get_sizenum_from_addr(env, prop_data_addr)
-    set_var(env, opinfo.store_var, size)
+    opinfo.store(env, size)
 
 # seems to be needed for practicality
 # test case:
@@ -438,14 +374,7 @@ def get_prop(env, opinfo):
             print_prop_list(env, obj)
             err(msg)
 
-    set_var(env, opinfo.store_var, result)
-
-    if DBG:
-        warn('    obj', obj,'(',get_obj_str(env,obj),')')
-        warn('    prop_num', prop_num)
-        warn('    result', result)
-        warn('    got_default_prop', got_default_prop)
-        print_prop_list(env, obj)
+    opinfo.store(env, result)
 
 def put_prop(env, opinfo):
     obj = opinfo.operands[0]
@@ -471,12 +400,6 @@ def put_prop(env, opinfo):
         msg += ' (sized at '+size+' bytes)'
         err(msg)
 
-    if DBG:
-        warn('    obj', obj,'(',get_obj_str(env,obj),')')
-        warn('    prop_num', prop_num)
-        warn('    val', val)
-        print_prop_list(env, obj)
-
 def get_prop_addr(env, opinfo):
     obj = opinfo.operands[0]
     prop_num = opinfo.operands[1]
@@ -487,14 +410,7 @@ def get_prop_addr(env, opinfo):
         result = 0
     else:
         result = compat_get_prop_addr(env, obj, prop_num)
-    set_var(env, opinfo.store_var, result)
-
-    if DBG:
-        warn('    obj', obj,'(',get_obj_str(env,obj),')')
-        warn('    prop_num', prop_num)
-        warn('    result', result)
-        if obj:
-            print_prop_list(env, obj)
+    opinfo.store(env, result)
 
 def get_next_prop(env, opinfo):
     obj = opinfo.operands[0]
@@ -504,16 +420,11 @@ def get_next_prop(env, opinfo):
         next_prop_num = compat_get_next_prop(env, obj, prop_num)
     else:
         next_prop_num = 0
-    set_var(env, opinfo.store_var, next_prop_num)
-
-    if DBG:
-        warn('    prop_num', prop_num)
-        warn('    next_prop_num', next_prop_num)
-        print_prop_list(env, obj)
+    opinfo.store(env, next_prop_num)
 
 def not_(env, opinfo):
     val = ~(opinfo.operands[0])
-    set_var(env, opinfo.store_var, val)
+    opinfo.store(env, val)
 
 def insert_obj(env, opinfo):
     obj = opinfo.operands[0]
@@ -538,10 +449,6 @@ def insert_obj(env, opinfo):
     set_sibling_num(env, obj, dest_child)
     set_child_num(env, dest, obj)
 
-    if DBG:
-        warn('    obj', obj, '(', get_obj_str(env,obj), ')')
-        warn('    dest', dest, '(', get_obj_str(env,dest), ')')
-
 def _remove_obj(env, obj):
     obj_addr = get_obj_addr(env, obj)
 
@@ -564,11 +471,6 @@ def _remove_obj(env, obj):
         if sibling_num != 0:
             set_sibling_num(env, child_num, sibling)
 
-    if DBG:
-        warn('    helper: _remove_obj')
-        warn('        obj', obj, '(', get_obj_str(env,obj), ')')
-        warn('        parent', parent, '(', get_obj_str(env,parent), ')')
-
 def remove_obj(env, opinfo):
     obj = opinfo.operands[0]
     if obj:
@@ -586,10 +488,6 @@ def set_attr(env, opinfo):
         old_val = env.mem[obj_addr+attr_byte]
         env.write8(obj_addr+attr_byte, old_val|mask)
 
-    if DBG:
-        warn('    obj', obj, '(', get_obj_str(env,obj), ')')
-        warn('    attr', attr)
-
 def clear_attr(env, opinfo):
     obj = opinfo.operands[0]
     attr = opinfo.operands[1]
@@ -602,10 +500,6 @@ def clear_attr(env, opinfo):
         old_val = env.mem[obj_addr+attr_byte]
         env.write8(obj_addr+attr_byte, old_val & ~mask)
 
-    if DBG:
-        warn('    obj', obj, '(', get_obj_str(env,obj), ')')
-        warn('    attr', attr)
-
 def test_attr(env, opinfo):
     obj = opinfo.operands[0]
     attr = opinfo.operands[1]
@@ -620,56 +514,107 @@ def test_attr(env, opinfo):
     else:
         result = False
     if result == opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
-
-    if DBG:
-        warn('    obj', obj, '(', get_obj_str(env,obj), ')')
-        warn('    attr', attr)
-
-class Frame:
-    def __init__(self, return_addr, num_args=0, locals=[], return_val_loc=None, stack=[]):
+        opinfo.branch(env)
+
+# the whole call stack is one flat list, env.stack, frotz-style. each
+# call pushes a FRAME_SIZE word header (return addr, store var, num args,
+# num locals, the caller's fp), then the routine's locals, and the
+# routine's own stack grows on past them. env.fp is the index of the
+# current routine's first local, so the header sits at fp-5 .. fp-1.
+# the bottom frame (the one main runs in) has a caller fp of 0.
+FRAME_SIZE = 5
+FP_RETURN_ADDR, FP_STORE_VAR, FP_NUM_ARGS, FP_NUM_LOCALS, FP_PREV_FP = -5, -4, -3, -2, -1
+
+# a copy of one frame, as handed to/from quetzal.py and for debugging
+class Frame(object):
+    def __init__(self, return_addr, num_args=0, locals=None, return_val_loc=None, stack=None):
         self.return_addr = return_addr
         self.num_args = num_args
-        self.locals = locals
-        self.stack = stack
+        self.locals = locals or []
+        self.stack = stack or []
         self.return_val_loc = return_val_loc
 
+def get_frames(env):
+    frames = []
+    stack, fp, top = env.stack, env.fp, len(env.stack)
+    while fp:
+        num_locals = stack[fp+FP_NUM_LOCALS]
+        frames.append(Frame(stack[fp+FP_RETURN_ADDR],
+                            stack[fp+FP_NUM_ARGS],
+                            stack[fp:fp+num_locals],
+                            stack[fp+FP_STORE_VAR],
+                            stack[fp+num_locals:top]))
+        top, fp = fp - FRAME_SIZE, stack[fp+FP_PREV_FP]
+    frames.reverse()
+    return frames
+
+def set_frames(env, frames):
+    stack, fp = [], 0
+    for frame in frames:
+        stack.extend((frame.return_addr, frame.return_val_loc, frame.num_args,
+                      len(frame.locals), fp))
+        fp = len(stack)
+        stack.extend(frame.locals)
+        stack.extend(frame.stack)
+    env.stack, env.fp = stack, fp
+
+def frame_depth(env):
+    depth, stack, fp = 0, env.stack, env.fp
+    while fp:
+        depth += 1
+        fp = stack[fp+FP_PREV_FP]
+    return depth
+
+# call_addr, code_ptr, a tuple of the initial local values for a
+# routine, and its python version if it has one (see accel.py). kept
+# in env.routine_headers by packed addr if the header is in static
+# mem (it can't change there), so a call to a routine seen before
+# just copies the tuple onto the stack.
+def read_routine_header(env, packed_addr):
+    call_addr = unpack_addr_call(env, packed_addr)
+    local_vars, code_ptr = parse_call_header(env, call_addr)
+    native = None
+    if call_addr >= env.static_mem_base:
+        if env.accel:
+            native = env.accel.native_for(env, packed_addr)
+        env.routine_headers[packed_addr] = call_addr, code_ptr, tuple(local_vars), native
+    return call_addr, code_ptr, tuple(local_vars), native
+
 def handle_call(env, packed_addr, args, store_var):
 
     if packed_addr == 0:
         if store_var != None:
             set_var(env, store_var, 0)
-        if DBG:
-            warn('op: calling 0 (returns false)')
         return
 
     return_addr = env.pc
-    call_addr = unpack_addr_call(env, packed_addr)
-    local_vars, code_ptr = parse_call_header(env, call_addr)
+    header = env.routine_headers.get(packed_addr)
+    if header is None:
+        header = read_routine_header(env, packed_addr)
+    call_addr, code_ptr, local_vars, native = header
 
     # args dropped if past len of locals arr
     num_args = min(len(args), len(local_vars))
-    for i in xrange(num_args):
-        local_vars[i] = args[i]
 
-    env.callstack.append(Frame(return_addr,
-                               num_args,
-                               local_vars,
-                               store_var))
+    if native is not None:
+        result = native(env, *args[:num_args])
+        if result is not None: # (otherwise it's left to the z-code)
+            if store_var != None:
+                set_var(env, store_var, result)
+            return
+
+    stack = env.stack
+    stack.extend((return_addr, store_var, num_args, len(local_vars), env.fp))
+    env.fp = len(stack)
+    if num_args:
+        stack.extend(args[:num_args])
+        stack.extend(local_vars[num_args:])
+    else:
+        stack.extend(local_vars)
     env.pc = code_ptr
 
-    if DBG:
-        warn('    helper: handle_call is calling', hex(call_addr))
-        warn('        returning to', hex(return_addr))
-        warn('        using args', args)
-        if store_var == None:
-            warn('        return val will be discarded')
-        else:
-            warn('        return val will be placed in', get_var_name(store_var))
-        warn('        num locals:', env.u8(call_addr))
-        warn('        local vals:', local_vars)
-        warn('        code ptr:', hex(code_ptr))
-        warn('        first inst:', env.u8(code_ptr))
+    if env.compiler:
+        env.compiler.note_call(env, call_addr)
 
 # known as "call" *and* "call_vs" in the docs
 # also does the job of call_vs2
@@ -706,62 +651,51 @@ def call_1n(env, opinfo):
 
 def check_arg_count(env, opinfo):
     arg_num = opinfo.operands[0]
-    frame = env.callstack[-1]
-    result = frame.num_args >= arg_num
+    num_args = env.stack[env.fp+FP_NUM_ARGS]
+    result = num_args >= arg_num
 
     if result == opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
-
-    if DBG:
-        warn('    arg_num', arg_num)
-        warn('    num args in frame', frame.num_args)
-        warn('    branch_offset', opinfo.branch_offset)
-        warn('    branch_on', opinfo.branch_on)
-        warn('    result', result)
-
-def handle_read(env, text_buffer, parse_buffer, time=0, routine=0):
-
-    if time != 0 or routine != 0:
-        if DBG:
-            err('interrupts requested but not impl\'d yet!')
+        opinfo.branch(env)
+
+# interrupts (time, routine) aren't impl'd yet. returns the opinfo of
+# the read the line went to: with the turn memo on (see memo.py), that
+# can be a later read, once replayed turns have skipped ahead to it
+def handle_read(env, opinfo):
+
+    memo = env.memo
+    if memo:
+        memo.end_turn(env, opinfo)
+    env.count_turn()
+    line = env.screen.get_line_of_input().lower()
+    if memo:
+        next_read = memo.start_turn(env, opinfo, line)
+        while next_read:
+            opinfo = next_read
+            env.count_turn()
+            line = env.screen.get_line_of_input().lower()
+            next_read = memo.start_turn(env, opinfo, line)
 
-    user_input = ascii_to_zscii(env.screen.get_line_of_input().lower())
-
-    fill_text_buffer(env, user_input, text_buffer)
-
-    if env.hdr.version < 5 or parse_buffer != 0:
-        handle_parse(env, text_buffer, parse_buffer)
-
-    # return ord('\r') as term char for now... 
-    # TODO: the right thing 
-    return ord('\r')
-
-def aread(env, opinfo):
     text_buffer = opinfo.operands[0]
     if len(opinfo.operands) > 1:
         parse_buffer = opinfo.operands[1]
     else:
         parse_buffer = 0
-    if len(opinfo.operands) == 4:
-        time, routine = opinfo.operands[2:4]
-    else:
-        time, routine = 0, 0
 
-    end_char = handle_read(env, text_buffer, parse_buffer, time, routine)
-    set_var(env, opinfo.store_var, end_char)
+    fill_text_buffer(env, ascii_to_zscii(line), text_buffer)
 
-def sread(env, opinfo):
-    text_buffer = opinfo.operands[0]
-    if len(opinfo.operands) > 1:
-        parse_buffer = opinfo.operands[1]
-    else:
-        parse_buffer = 0
-    if len(opinfo.operands) == 4:
-        time, routine = opinfo.operands[2:4]
-    else:
-        time, routine = 0, 0
+    if should_parse_after_read(env, parse_buffer):
+        handle_parse(env, text_buffer, parse_buffer)
+
+    return opinfo
 
-    handle_read(env, text_buffer, parse_buffer, time, routine)
+def aread(env, opinfo):
+    opinfo = handle_read(env, opinfo)
+    # store ord('\r') as term char for now...
+    # TODO: the right thing
+    opinfo.store(env, ord('\r'))
+
+def sread(env, opinfo):
+    handle_read(env, opinfo)
 
 def tokenize(env, opinfo):
     text_buffer = opinfo.operands[0]
@@ -785,39 +719,32 @@ def read_char(env, opinfo):
     if len(opinfo.operands) > 1:
         if len(opinfo.operands) != 3:
             err('read_char: num operands must be 1 or 3')
-        if opinfo.operands[1] != 0 or opinfo.operands[2] != 0:
-            if DBG:
-                warn('read_char: interrupts not impl\'d yet!')
+        # (interrupts not impl'd yet)
     c = ascii_to_zscii(env.screen.getch())[0]
-    set_var(env, opinfo.store_var, c)
+    opinfo.store(env, c)
 
 def set_font(env, opinfo):
     font_num = opinfo.operands[0]
     if font_num == 0:
-        set_var(env, opinfo.store_var, 1)
+        opinfo.store(env, 1)
     if font_num != 1:
-        set_var(env, opinfo.store_var, 0)
+        opinfo.store(env, 0)
     else:
-        set_var(env, opinfo.store_var, 1)
+        opinfo.store(env, 1)
 
 def pop(env, opinfo):
-    frame = env.callstack[-1]
-    frame.stack.pop()
+    env.stack.pop()
 
 def pull(env, opinfo):
     var = opinfo.operands[0]
 
-    frame = env.callstack[-1]
-    if len(frame.stack) == 0:
+    stack, fp = env.stack, env.fp
+    if len(stack) == fp + stack[fp+FP_NUM_LOCALS]:
         err('illegal op: attempted to pull from empty stack')
 
-    result = frame.stack.pop()
+    result = stack.pop()
     set_var(env, var, result, push_stack=False)
 
-    if DBG:
-        warn('    result', result)
-        warn('    dest', get_var_name(var))
-
 def buffer_mode(env, opinfo):
     env.screen.finish_wrapping()
 
@@ -825,7 +752,7 @@ def buffer_mode(env, opinfo):
     env.use_buffered_output = (flag == 1)
 
 def output_stream(env, opinfo):
-    stream = to_signed_word(opinfo.operands[0])
+    stream = opinfo.operands[0]
     if stream < 0:
         stream = abs(stream)
         if stream == 3:
@@ -853,35 +780,21 @@ def restart(env, opinfo):
 
 def log_shift(env, opinfo):
     number = opinfo.operands[0]
-    places = to_signed_word(opinfo.operands[1])
+    places = opinfo.operands[1]
     if places < 0:
         result = number >> abs(places)
     else:
         result = number << places
-    set_var(env, opinfo.store_var, result)
-
-    if DBG:
-        warn('    result',result)
+    opinfo.store(env, result)
 
 def art_shift(env, opinfo):
-    number = to_signed_word(opinfo.operands[0])
-    places = to_signed_word(opinfo.operands[1])
+    number = opinfo.operands[0]
+    places = opinfo.operands[1]
     if places < 0:
         result = number >> abs(places)
     else:
         result = number << places
-    set_var(env, opinfo.store_var, result)
-
-    if DBG:
-        warn('    result',result)
-
-def get_file_len(env):
-    if env.hdr.version < 4:
-        return 2*env.hdr.file_len
-    elif env.hdr.version < 6:
-        return 4*env.hdr.file_len
-    else:
-        return 8*env.hdr.file_len
+    opinfo.store(env, result)
 
 def verify(env, opinfo):
     vsum = 0
@@ -891,36 +804,53 @@ def verify(env, opinfo):
     result = vsum == env.hdr.checksum
 
     if result == opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
-
-    if DBG:
-        warn('    vsum', vsum)
-        warn('    checksum in header', env.hdr.checksum)
-        warn('    branch_on', opinfo.branch_on)
-        warn('    result', result)
+        opinfo.branch(env)
 
 def piracy(env, opinfo):
-    handle_branch(env, opinfo.branch_offset)
+    opinfo.branch(env)
 
 def copy_table(env, opinfo):
     first = opinfo.operands[0]
     second = opinfo.operands[1]
-    size = to_signed_word(opinfo.operands[2])
+    size = opinfo.operands[2]
+    env.own_mem()
+    mem = env.mem
     if second == 0:
         # zeros out first
         size = abs(size)
+        if in_dyn_mem(env, first, size):
+            mem[first:first+size] = '\0' * size
+            env.dyn_mem_written(first, first+size)
+            return
         for i in xrange(size):
             env.write8(first+i, 0)
     elif size > 0:
         # protects against corruption of overlapping tables
-        tab = env.mem[first:first+size]
+        if first + size <= len(mem) and in_dyn_mem(env, second, size):
+            mem[second:second+size] = mem[first:first+size]
+            env.dyn_mem_written(second, second+size)
+            return
+        tab = mem[first:first+size]
         for i in xrange(size):
             env.write8(second+i, tab[i])
     elif size < 0:
         # allows for the corruption of overlapping tables
         size = abs(size)
+        if first + size <= len(mem) and in_dyn_mem(env, second, size):
+            if first < second < first + size:
+                # the bytes before second just repeat all the way along
+                run = mem[first:second]
+                mem[second:second+size] = (run * (size // len(run) + 1))[:size]
+            else:
+                mem[second:second+size] = mem[first:first+size]
+            env.dyn_mem_written(second, second+size)
+            return
         for i in xrange(size):
-            env.write8(second+i, env.mem[first+i])
+            env.write8(second+i, mem[first+i])
+
+# whether writes to [addr, addr+size) all pass env.check_dyn_mem
+def in_dyn_mem(env, addr, size):
+    return size and 0x36 < addr and addr + size <= env.static_mem_base
 
 def scan_table(env, opinfo):
     val = opinfo.operands[0]
@@ -934,23 +864,36 @@ def scan_table(env, opinfo):
     field_len = form & 127
 
     addr = 0
-    for i in xrange(tab_len):
-        test_addr = tab_addr + i*field_len
+    mem = env.mem
+    end = tab_addr + tab_len*field_len
+    if field_len and end < len(mem):
+        # search a strided slice of the first bytes, then check the rest
+        firsts = mem[tab_addr:end:field_len]
         if val_size == 2:
-            test_val = env.u16(test_addr)
+            seconds = mem[tab_addr+1:end+1:field_len]
+            i = firsts.find(chr(val >> 8))
+            while i != -1 and seconds[i] != val & 0xff:
+                i = firsts.find(chr(val >> 8), i+1)
+        elif val < 256:
+            i = firsts.find(chr(val))
         else:
-            test_val = env.u8(test_addr)
-        if val == test_val:
-            addr = test_addr
-            break
+            i = -1
+        if i != -1:
+            addr = tab_addr + i*field_len
+    else:
+        for i in xrange(tab_len):
+            test_addr = tab_addr + i*field_len
+            if val_size == 2:
+                test_val = env.u16(test_addr)
+            else:
+                test_val = env.u8(test_addr)
+            if val == test_val:
+                addr = test_addr
+                break
     found = addr != 0
-    set_var(env, opinfo.store_var, addr)
+    opinfo.store(env, addr)
     if found == opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
-
-    if DBG:
-        warn('    found', found)
-        warn('    addr',addr)
+        opinfo.branch(env)
 
 # TODO: make sure this actually works
 def print_table(env, opinfo):
@@ -972,8 +915,8 @@ def print_table(env, opinfo):
     col = env.cursor[env.current_window][1]
     for i in xrange(height):
         row = env.cursor[env.current_window][0]
-        line = [env.u8(tab_addr + i*(width+skip) + j) for j in xrange(width)]
-        write(env, zscii_to_ascii(env, line))
+        start = tab_addr + i*(width+skip)
+        write(env, zscii_to_ascii(env, env.mem[start:start+width]))
         if i < height - 1:
             env.screen.finish_wrapping()
             if (env.current_window == 0 and row < env.hdr.screen_height_units-1 or
@@ -989,7 +932,7 @@ def nop(env, opinfo):
 def erase_window(env, opinfo):
     env.screen.finish_wrapping()
 
-    window = to_signed_word(opinfo.operands[0])
+    window = opinfo.operands[0]
 
     if window in [0, -1, -2]:
         env.screen.blank_bottom_win()
@@ -1047,9 +990,7 @@ def restore_z3(env, opinfo):
 def restore(env, opinfo):
     # TODO handle optional operands
     if len(opinfo.operands) > 0:
-        if DBG:
-            warn('restore: found operands (not yet impld): '+str(opinfo.operands))
-        set_var(env, opinfo.store_var, 0)
+        opinfo.store(env, 0)
         return
 
     filename = env.screen.get_line_of_input('input save filename: ')
@@ -1060,33 +1001,31 @@ def restore(env, opinfo):
         set_var(env, env.u8(env.pc), 2)
         env.pc += 1
     else:
-        set_var(env, opinfo.store_var, 0)
+        opinfo.store(env, 0)
 
 def save_z3(env, opinfo):
     filename = env.screen.get_line_of_input('input save filename: ')
-    saved = quetzal.write(env, filename)
+    saved = quetzal.write(env, filename, opinfo.branch_ptr)
     if saved and opinfo.branch_on:
-        handle_branch(env, opinfo.branch_offset)
+        opinfo.branch(env)
 
 def save(env, opinfo):
     # TODO handle optional operands
     if len(opinfo.operands) > 0:
-        if DBG:
-            warn('restore: found operands (not yet impld): '+str(opinfo.operands))
-        set_var(env, opinfo.store_var, 0)
+        opinfo.store(env, 0)
         return
 
     filename = env.screen.get_line_of_input('input save filename: ')
-    if quetzal.write(env, filename):
-        set_var(env, opinfo.store_var, 1)
+    if quetzal.write(env, filename, opinfo.store_ptr):
+        opinfo.store(env, 1)
     else:
-        set_var(env, opinfo.store_var, 0)
+        opinfo.store(env, 0)
 
 def set_cursor(env, opinfo):
     env.screen.finish_wrapping()
 
-    row = to_signed_word(opinfo.operands[0])
-    col = to_signed_word(opinfo.operands[1])
+    row = opinfo.operands[0]
+    col = opinfo.operands[1]
     if row < 1: # why do we not error out here?
         row = 1
     if col < 1: # same question
@@ -1095,12 +1034,8 @@ def set_cursor(env, opinfo):
     # ignores win 0 (S 8.7.2.3)
     if env.current_window == 1:
         if col > env.hdr.screen_width_units:
-            if DBG:
-                warn('set_cursor: set outside screen width', col)
             col = env.hdr.screen_width_units
         if row > env.hdr.screen_height_units:
-            if DBG:
-                warn('set_cursor: set outside screen height', row)
             row = env.hdr.screen_height_units
         # see 3rd to last note at bottom of section 8
         env.top_window_height = max(env.top_window_height, row-1)
@@ -1133,23 +1068,26 @@ def check_unicode(env, opinfo):
         result = 3
     else:
         result = 0
-    set_var(env, opinfo.store_var, result)
+    opinfo.store(env, result)
 
 def catch(env, opinfo):
-    set_var(env, opinfo.store_var, len(env.callstack))
+    opinfo.store(env, frame_depth(env))
 
 def throw(env, opinfo):
     ret_val = opinfo.operands[0]
     callstack_len = opinfo.operands[1]
 
-    while len(env.callstack) > callstack_len:
-        env.callstack.pop()
+    stack, depth = env.stack, frame_depth(env)
+    while depth > callstack_len:
+        fp = env.fp
+        env.fp = stack[fp+FP_PREV_FP]
+        del stack[fp-FRAME_SIZE:]
+        depth -= 1
 
     handle_return(env, ret_val)
 
 def show_status(env, opinfo):
-    if DBG:
-        warn('    (not impld)')
+    pass # (not impld)
 
 def set_text_style(env, opinfo):
     style = opinfo.operands[0]
@@ -1166,14 +1104,31 @@ def set_text_style(env, opinfo):
     #     env.text_style = 'fixed_pitch'
 
 def sound_effect(env, opinfo):
-    if DBG:
-        warn('    (not impld)')
+    pass # (not impld)
 
+# see undo.py. the undo ring isn't part of the memo's key, so turns
+# that use it can't be replayed (with undo off, there's no ring to use)
 def save_undo(env, opinfo):
-    set_var(env, opinfo.store_var, -1)
-    if DBG:
-        warn('    (not impld for now)')
-        warn('    (but at least I can notify the game of that)')
+    if not env.undo:
+        opinfo.store(env, -1) # not available
+        return
+    if env.memo:
+        env.memo.taint(env)
+    # saved from before the store, restore_undo stores 2 in its place
+    env.undo.save(env, opinfo.store_var)
+    opinfo.store(env, 1)
+
+def restore_undo(env, opinfo):
+    if not env.undo:
+        opinfo.store(env, 0)
+        return
+    if env.memo:
+        env.memo.taint(env)
+    store_var = env.undo.restore(env)
+    if store_var is None:
+        opinfo.store(env, 0)
+    else:
+        set_var(env, store_var, 2)
 
 def write(env, text):
     # stream 3 overrides all other output
@@ -587,3 +587,150 @@ def read_packed_string(env, addr):
             break
         addr += 2
     return packed_string
+
+def get_file_len(env):
+    if env.hdr.version < 4:
+        return 2*env.hdr.file_len
+    elif env.hdr.version < 6:
+        return 4*env.hdr.file_len
+    else:
+        return 8*env.hdr.file_len
+
+def should_parse_after_read(env, parse_buffer):
+    return env.hdr.version < 5 or parse_buffer != 0
+
+# the helpers above test env.hdr.version on every call. the ones that
+# sit on hot paths get remade here with the story's version (and the
+# header addrs they need) already decided, and setup_compat() binds
+# them over the plain names: here, and in every namespace given (i.e.
+# the modules that did 'from ops_impl_compat import *'), so at run time
+# nothing looks at the version. the versions above stay as the
+# reference, and for anything that runs before setup.
+def make_versioned_helpers(env):
+    version = env.hdr.version
+
+    # obj_base is where obj 0 would be, so obj n is at obj_base + size*n
+    if version < 4:
+        obj_size, props = 9, 7
+        obj_base = env.hdr.obj_tab_base + 31*2 - obj_size
+    else:
+        obj_size, props = 14, 12
+        obj_base = env.hdr.obj_tab_base + 63*2 - obj_size
+
+    def get_obj_addr(env, obj):
+        return obj_base + obj_size*obj
+
+    def get_obj_desc_addr(env, obj):
+        addr = obj_base + obj_size*obj + props
+        mem = env.mem
+        return (mem[addr] << 8 | mem[addr+1]) + 1 # past len byte
+
+    def get_prop_list_start(env, obj):
+        addr = obj_base + obj_size*obj + props
+        mem = env.mem
+        prop_tab_addr = mem[addr] << 8 | mem[addr+1]
+        return prop_tab_addr + 1 + 2*mem[prop_tab_addr]
+
+    if version < 4:
+        def get_parent_num(env, obj):
+            return env.mem[obj_base + 9*obj + 4]
+        def get_sibling_num(env, obj):
+            return env.mem[obj_base + 9*obj + 5]
+        def get_child_num(env, obj):
+            return env.mem[obj_base + 9*obj + 6]
+        def set_parent_num(env, obj, num):
+            env.write8(obj_base + 9*obj + 4, num)
+        def set_sibling_num(env, obj, num):
+            env.write8(obj_base + 9*obj + 5, num)
+        def set_child_num(env, obj, num):
+            env.write8(obj_base + 9*obj + 6, num)
+
+        def get_prop_size(env, prop_ptr):
+            return (env.mem[prop_ptr] >> 5) + 1
+        def get_prop_num(env, prop_ptr):
+            return env.mem[prop_ptr] & 31
+        def get_prop_data_ptr(env, prop_ptr):
+            return prop_ptr+1
+        def get_sizenum_ptr(env, prop_data_ptr):
+            return prop_data_ptr-1
+    else:
+        def get_parent_num(env, obj):
+            addr, mem = obj_base + 14*obj + 6, env.mem
+            return mem[addr] << 8 | mem[addr+1]
+        def get_sibling_num(env, obj):
+            addr, mem = obj_base + 14*obj + 8, env.mem
+            return mem[addr] << 8 | mem[addr+1]
+        def get_child_num(env, obj):
+            addr, mem = obj_base + 14*obj + 10, env.mem
+            return mem[addr] << 8 | mem[addr+1]
+        def set_parent_num(env, obj, num):
+            env.write16(obj_base + 14*obj + 6, num)
+        def set_sibling_num(env, obj, num):
+            env.write16(obj_base + 14*obj + 8, num)
+        def set_child_num(env, obj, num):
+            env.write16(obj_base + 14*obj + 10, num)
+
+        def get_prop_size(env, prop_ptr):
+            first_byte = env.mem[prop_ptr]
+            if first_byte & 128:
+                size_byte = env.mem[prop_ptr+1]
+                if not (size_byte & 128):
+                    msg = 'malformed prop size byte: '+bin(size_byte)
+                    msg += ' - first_byte:'+bin(first_byte)
+                    msg += ' - prop_ptr:'+hex(prop_ptr)
+                    err(msg)
+                return (size_byte & 63) or 64 # zero len == 64
+            if first_byte & 64:
+                return 2
+            return 1
+        def get_prop_num(env, prop_ptr):
+            return env.mem[prop_ptr] & 63
+        def get_prop_data_ptr(env, prop_ptr):
+            if env.mem[prop_ptr] & 128:
+                return prop_ptr+2
+            return prop_ptr+1
+        def get_sizenum_ptr(env, prop_data_ptr):
+            if env.mem[prop_data_ptr-1] & 128:
+                return prop_data_ptr-2
+            return prop_data_ptr-1
+
+    routine_offset = string_offset = 0
+    if version == 7:
+        routine_offset = env.hdr.routine_offset * 8
+        string_offset = env.hdr.string_offset * 8
+    pack_mul = unpack_addr(1, version)
+    def unpack_addr_call(env, addr):
+        return addr*pack_mul + routine_offset
+    def unpack_addr_print_paddr(env, addr):
+        return addr*pack_mul + string_offset
+
+    if version < 5:
+        def parse_call_header(env, call_addr):
+            mem = env.mem
+            num_locals = mem[call_addr]
+            if num_locals > 15:
+                err('calling a non-function (more than 15 local vars)')
+            locals = [mem[i] << 8 | mem[i+1] for i in xrange(call_addr+1, call_addr+1+2*num_locals, 2)]
+            return locals, call_addr + 1 + 2*num_locals
+    else:
+        def parse_call_header(env, call_addr):
+            num_locals = env.mem[call_addr]
+            if num_locals > 15:
+                err('calling a non-function (more than 15 local vars)')
+            return [0] * num_locals, call_addr + 1
+
+    fns = [get_obj_addr, get_obj_desc_addr, get_prop_list_start,
+           get_parent_num, get_sibling_num, get_child_num,
+           set_parent_num, set_sibling_num, set_child_num,
+           get_prop_size, get_prop_num, get_prop_data_ptr, get_sizenum_ptr,
+           unpack_addr_call, unpack_addr_print_paddr, parse_call_header]
+    return dict((fn.__name__, fn) for fn in fns)
+
+def setup_compat(env, namespaces):
+    helpers = make_versioned_helpers(env)
+    ours = globals()
+    for name, fn in helpers.items():
+        for namespace in namespaces:
+            if namespace.get(name) is ours[name]:
+                namespace[name] = fn
+        ours[name] = fn
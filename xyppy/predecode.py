@@ -0,0 +1,95 @@
+# predecode.py (as in this file decodes the story ahead of time)
+#
+# walks the code from the start pc, and from every routine called
+# with a constant packed addr, filling env.icache before the game
+# gets there. it runs in a background thread, so the first turn
+# doesn't wait on it. only static mem is walked: nothing there can
+# change under us, and the cache only has to take new entries (via
+# setdefault, so anything the game thread already put in, like a
+# compiled routine, stays put). a flush (tracing switched on or off)
+# stops it: whatever it had decoded by then was made with the old
+# handlers, so none of it may go in after.
+
+import threading
+import time
+
+from debug import warn
+
+import ops_decode
+import ops_impl_compat
+
+class Predecoder(object):
+    def __init__(self, env):
+        self.env = env
+        self.num_insts = 0
+        self.routines = set()
+        self.elapsed = None # set once done
+        self.stopped = False # by a flush
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        t0 = time.time()
+        env, icache = self.env, self.env.icache
+        static_mem_base = env.hdr.static_mem_base
+        flushes = icache.flushes
+        seen = set()
+        todo = [env.hdr.pc]
+        while todo:
+            pc = todo.pop()
+            if pc in seen or pc < static_mem_base:
+                continue
+            if icache.limit and len(icache) >= icache.limit:
+                break
+            seen.add(pc)
+            try:
+                inst = ops_decode.make_inst(env, pc)
+            except (KeyError, IndexError): # not code after all
+                continue
+            with icache.flush_lock:
+                if icache.flushes != flushes:
+                    self.stopped = True
+                    break
+                if icache.setdefault(pc, inst) is inst:
+                    if icache.limit:
+                        icache.order.append((pc, inst))
+                    self.num_insts += 1
+
+            op, opinfo = inst.op, inst.opinfo
+            todo.extend(ops_decode.successors(op, opinfo, inst.next_pc))
+            if op.__name__ in ops_decode.call_ops and not self.first_operand_is_var(opinfo):
+                code_ptr = self.routine_code_ptr(opinfo.operands[0])
+                if code_ptr is not None:
+                    todo.append(code_ptr)
+        self.elapsed = time.time() - t0
+
+    def first_operand_is_var(self, opinfo):
+        return any(i == 0 for i, var_num in opinfo.var_op_info)
+
+    def routine_code_ptr(self, packed_addr):
+        if packed_addr == 0:
+            return None
+        mem = self.env.mem
+        call_addr = ops_impl_compat.unpack_addr_call(self.env, packed_addr)
+        # only a guess, so anything parse_call_header would err() on (or
+        # read past the end for) is just not a routine
+        if call_addr >= len(mem) or mem[call_addr] > 15:
+            return None
+        if call_addr + 1 + 2*mem[call_addr] > len(mem):
+            return None
+        self.routines.add(call_addr)
+        local_vars, code_ptr = ops_impl_compat.parse_call_header(self.env, call_addr)
+        return code_ptr
+
+    def report(self):
+        if self.elapsed is None:
+            warn('predecode: still running,', self.num_insts, 'insts in',
+                 len(self.routines), 'routines so far')
+        else:
+            warn('predecode:', self.num_insts, 'insts in', len(self.routines),
+                 'routines, took', '%.2fs' % self.elapsed +
+                 (' (stopped by a cache flush)' if self.stopped else ''))
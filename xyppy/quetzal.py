@@ -1,5 +1,6 @@
 from __future__ import print_function
 import sys
+import re
 import struct
 from iff import Chunk, FormChunk, packHdr
 
@@ -14,50 +15,31 @@ class IFhdChunk(Chunk):
         obj.pc = struct.unpack('>I', '\0'+chunk.data[10:13])[0]
         return obj
     @classmethod
-    def from_env(cls, env):
+    def from_env(cls, env, pc):
         obj = cls()
         obj.name = 'IFhd'
         obj.size = 13
         obj.release = env.hdr.release
         obj.serial = ''.join(map(chr, env.hdr.serial))
         obj.checksum = env.hdr.checksum
-        if env.hdr.version < 4:
-            obj.pc = env.last_pc_branch_var
-        else:
-            obj.pc = env.last_pc_store_var
+        obj.pc = pc
         return obj
     def pack(self):
         return (packHdr(self) +
                 struct.pack('>H6sH', self.release, self.serial, self.checksum) +
                 struct.pack('>I', self.pc)[1:])
 
+# each zero byte is followed by how many more zeros came after it (up
+# to 255). runs are found by re so this goes at C speed, undo.py
+# packs its deltas with it too
 def decRLE(mem):
-    bigmem = ''
-    i = 0
-    while i < len(mem):
-        bigmem += mem[i]
-        if mem[i] == '\0':
-            bigmem += '\0' * ord(mem[i+1])
-            i += 2
-        else:
-            i += 1
-    return bigmem
+    return zero_code.sub(lambda m: '\0' * (ord(m.group(1)) + 1), mem)
 
 def encRLE(mem):
-    small_mem = ''
-    i = 0
-    while i < len(mem):
-        small_mem += mem[i]
-        if mem[i] == '\0':
-            zero_run = 0
-            i += 1
-            while i < len(mem) and mem[i] == '\0' and zero_run < 255:
-                zero_run += 1
-                i += 1
-            small_mem += chr(zero_run)
-        else:
-            i += 1
-    return small_mem
+    return zero_run.sub(lambda m: '\0' + chr(len(m.group()) - 1), mem)
+
+zero_code = re.compile('\0(.)', re.S)
+zero_run = re.compile('\0{1,256}')
 
 class CMemChunk(Chunk):
     @classmethod
@@ -71,9 +53,15 @@ class CMemChunk(Chunk):
     def from_env(cls, env):
         obj = cls()
         obj.name = 'CMem'
-        obj.mem = env.mem[:env.hdr.static_mem_base]
-        for i in xrange(len(obj.mem)):
-            obj.mem[i] ^= ord(env.orig_mem[i])
+        obj.mem = bytearray(env.static_mem_base)
+        # only pages written since start/restart can differ from the story
+        # file, plus the header, which the interpreter writes directly
+        pages = set(env.dirty_pages(env.reset_mark))
+        pages.add(0)
+        for page in pages:
+            start, end = env.page_range(page)
+            for i in xrange(start, end):
+                obj.mem[i] = env.mem[i] ^ ord(env.orig_mem[i])
         while obj.mem[-1] == 0:
             obj.mem.pop()
         obj.mem = ''.join(map(chr, obj.mem))
@@ -105,6 +93,7 @@ class UMemChunk(Chunk):
         return packHdr(self) + self.mem
 
 # duck-typing compatible with ops_impl's Frame class
+# (see ops_impl.get_frames/set_frames)
 class QFrame(object):
     @classmethod
     def from_packed(cls, data):
@@ -186,7 +175,7 @@ class StksChunk(Chunk):
     def from_env(cls, env):
         obj = cls()
         obj.name = 'Stks'
-        obj.frames = [QFrame.from_frame(f) for f in env.callstack]
+        obj.frames = [QFrame.from_frame(f) for f in env.get_frames()]
         return obj
     def pack(self):
         framestr = ''.join([f.pack() for f in self.frames])
@@ -207,10 +196,12 @@ def read(filename):
                 stksChunk = StksChunk.from_chunk(chunk)
     return formChunk.subname, hdChunk, memChunk, stksChunk.frames
 
-def write(env, filename):
+# pc is where the save inst's branch byte (v3) or store byte (v4+) is,
+# since that's where a restore picks up
+def write(env, filename, pc):
     try:
         with open(filename, 'wb') as f:
-            chunks = [IFhdChunk.from_env(env),
+            chunks = [IFhdChunk.from_env(env, pc),
                       CMemChunk.from_env(env),
                       StksChunk.from_env(env)]
             formChunk = FormChunk.from_chunk_list('IFZS', chunks)
@@ -246,9 +237,10 @@ def load_to_env(env, filename):
                 env.mem[i] ^= ord(memChunk.mem[i])
             else:
                 env.mem[i] = ord(memChunk.mem[i])
+        env.dyn_mem_replaced()
         env.fixup_after_restore()
         env.pc = hdrChunk.pc
-        env.callstack = frames
+        env.set_frames(frames)
 
         # pc is now in wrong place:
         # must fix based on z version
@@ -0,0 +1,100 @@
+# tracing.py (as in this file shows what the game is doing, inst by inst)
+#
+# tracing is a mode you switch into at run time (--trace, or SIGUSR1 to
+# flip it), not a build option. set_tracing() swaps a wrapped copy of
+# every handler into the opcode tables and throws out all decoded insts,
+# so everything decoded from then on goes through a wrapper that logs
+# the inst before and after it runs. fusion and routine compilation
+# are off while tracing (both would skip the wrappers). switching back
+# puts the plain tables back, so the normal path never checks for it.
+
+from debug import warn
+
+import ops
+import ops_decode
+
+# ops whose first operand (and second, for the pairs) is an object
+obj_ops = set(['get_parent', 'get_child', 'get_sibling', 'print_obj', 'remove_obj',
+               'get_prop', 'get_prop_addr', 'get_next_prop', 'put_prop',
+               'set_attr', 'clear_attr', 'test_attr'])
+obj_pair_ops = set(['jin', 'insert_obj'])
+
+def describe_operands(env, name, operands):
+    if name in ('print_', 'print_ret'):
+        text = ops.unpack_string(env, operands)
+        if len(text) > 40:
+            return repr(text[:40] + '...')
+        return repr(text)
+    return operands
+
+def describe_obj(env, obj):
+    if obj == 0:
+        return '0 (nothing)'
+    return '%d (%s)' % (obj, ops.get_obj_str(env, obj))
+
+def branch_dest(env, opinfo):
+    offset = opinfo.branch_offset
+    if offset == 0 or offset == 1:
+        return 'return ' + str(offset)
+    return hex(opinfo.branch_to)
+
+def traced(op):
+    name = op.__name__
+    def traced_op(env, opinfo):
+        next_pc = env.pc
+        pc = opinfo.pc
+        warn(hex(pc), name, ' '.join('%02x' % b for b in env.mem[pc:next_pc]))
+        warn('    operands', describe_operands(env, name, opinfo.operands))
+        if name in obj_ops and opinfo.operands:
+            warn('    obj', describe_obj(env, opinfo.operands[0]))
+        elif name in obj_pair_ops:
+            warn('    objs', describe_obj(env, opinfo.operands[0]),
+                 describe_obj(env, opinfo.operands[1]))
+        if opinfo.branch_offset is not None:
+            warn('    branch on', bool(opinfo.branch_on), 'to', branch_dest(env, opinfo))
+        depth = ops.frame_depth(env)
+
+        op(env, opinfo)
+
+        if opinfo.store_var is not None and name not in ops_decode.call_ops:
+            warn('    stored', ops.get_var(env, opinfo.store_var, pop_stack=False),
+                 'in', ops.get_var_name(opinfo.store_var))
+        new_depth = ops.frame_depth(env)
+        if new_depth > depth:
+            warn('    called', hex(env.pc), 'locals', env.stack[env.fp:])
+        elif new_depth < depth:
+            warn('    returned to', hex(env.pc))
+        elif env.pc != next_pc:
+            warn('    now at', hex(env.pc))
+    traced_op.__name__ = name # ops_decode and friends go by op name
+    traced_op.untraced = op
+    return traced_op
+
+def swap_tables(wrap):
+    for table in (ops.dispatch, ops.ext_dispatch):
+        for opcode, op in enumerate(table):
+            if op is not None:
+                table[opcode] = wrap(op)
+
+def is_tracing(env):
+    return env.untraced_state is not None
+
+def set_tracing(env, on):
+    if on == is_tracing(env):
+        return
+    if on:
+        env.untraced_state = env.compiler, ops_decode.FUSE
+        env.compiler, ops_decode.FUSE = None, False
+        swap_tables(traced)
+    else:
+        env.compiler, ops_decode.FUSE = env.untraced_state
+        env.untraced_state = None
+        swap_tables(lambda op: op.untraced)
+    env.icache.flush()
+    if env.compiler:
+        # its entries went with the flush, the next call puts them back
+        env.compiler.icache = None
+    warn('tracing', 'on' if on else 'off')
+
+def toggle_tracing(env):
+    set_tracing(env, not is_tracing(env))
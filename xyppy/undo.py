@@ -0,0 +1,147 @@
+# undo.py (as in this file keeps undo states for save_undo/restore_undo)
+#
+# the newest state's dyn mem is kept whole (base). each state also keeps
+# a delta back to the one before it: the pages written in between,
+# xored against base and packed with quetzal's zero-run rle, like a
+# CMem chunk. bytes that didn't change xor to zero, so a delta is mostly
+# runs and packs small. undoing copies base into env.mem and xors the
+# newest delta into base, leaving base as the state before, ready for
+# the next undo. the call stack goes along as a tuple.
+#
+# base matches env.mem except on pages written since mark, and on the
+# stale pages the last undo xored into base (those differ too).
+
+import copy
+import time
+from binascii import hexlify, unhexlify
+
+from debug import warn
+import quetzal
+
+MAX_STATES = 50
+MAX_BYTES = 2 << 20
+
+class UndoRing(object):
+    def __init__(self, max_states=MAX_STATES, max_bytes=MAX_BYTES):
+        self.max_states = max_states
+        self.max_bytes = max_bytes # base and all the states, roughly
+        self.base = None
+        self.mark = 0
+        self.stale_pages = set()
+        self.states = [] # UndoStates, oldest first
+        self.size = 0 # bytes in self.states
+        self.saves = self.restores = 0
+        self.save_time = self.restore_time = 0.0
+
+    # the pages where env.mem and base differ, and each one's bytes from
+    # both, end to end
+    def changes(self, env):
+        pages, now, then = [], [], []
+        for page in sorted(self.stale_pages.union(env.dirty_pages(self.mark))):
+            start, end = env.page_range(page)
+            mine, theirs = str(env.mem[start:end]), str(self.base[start:end])
+            if mine != theirs: # pages often get written back as they were
+                pages.append(page)
+                now.append(mine)
+                then.append(theirs)
+        return pages, ''.join(now), ''.join(then)
+
+    # store_var is the save_undo's, for restore to put 2 in
+    def save(self, env, store_var):
+        start_time = time.time()
+        if self.base is None:
+            self.base = env.mem[:env.static_mem_base]
+            state = UndoState(env, store_var, (), '')
+        else:
+            pages, now, then = self.changes(env)
+            state = UndoState(env, store_var, pages, quetzal.encRLE(xor(now, then)))
+            put_pages(env, self.base, pages, now)
+        self.mark = env.dirty_mark()
+        self.stale_pages = set()
+        self.states.append(state)
+        self.size += state.size
+        while (len(self.states) > self.max_states or
+               len(self.states) > 1 and len(self.base) + self.size > self.max_bytes):
+            self.size -= self.states.pop(0).size
+        # nothing comes before the oldest, so its delta can go (on a
+        # copy, clones share the states)
+        oldest = self.states[0]
+        if oldest.pages:
+            self.states[0] = oldest = copy.copy(oldest)
+            self.size -= len(oldest.delta)
+            oldest.size -= len(oldest.delta)
+            oldest.pages, oldest.delta = (), ''
+        self.saves += 1
+        self.save_time += time.time() - start_time
+
+    # puts the newest state back and returns its store_var, or returns
+    # None if there's nothing to undo
+    def restore(self, env):
+        if not self.states:
+            return None
+        start_time = time.time()
+        env.own_mem()
+        pages, now, then = self.changes(env)
+        put_pages(env, env.mem, pages, then)
+        for page in pages:
+            env.dyn_mem_written(*env.page_range(page))
+
+        state = self.states.pop()
+        self.size -= state.size
+        if state.pages:
+            mine = ''.join(str(self.base[start:end])
+                           for start, end in map(env.page_range, state.pages))
+            put_pages(env, self.base, state.pages, xor(mine, quetzal.decRLE(state.delta)))
+        self.mark = env.dirty_mark()
+        self.stale_pages = set(state.pages)
+
+        # only these flags2 bits (transcript, fixed pitch) outlast the state
+        bits_to_save = env.hdr.flags2 & 3
+        env.stack[:] = state.stack
+        env.fp, env.pc = state.fp, state.pc
+        env.hdr.flags2 &= ~3
+        env.hdr.flags2 |= bits_to_save
+        env.dyn_mem_written(0x10, 0x12)
+        self.restores += 1
+        self.restore_time += time.time() - start_time
+        return state.store_var
+
+    # a separate ring in the same state, for Env.clone()
+    def clone(self):
+        ring = UndoRing(self.max_states, self.max_bytes)
+        if self.base is not None:
+            ring.base = bytearray(self.base)
+        ring.mark = self.mark
+        ring.stale_pages = set(self.stale_pages)
+        ring.states = list(self.states) # never changed once made
+        ring.size = self.size
+        return ring
+
+    def report(self):
+        def avg_ms(total, count):
+            return '%.3fms' % (1000 * total / count if count else 0)
+        warn('undo:', len(self.states), 'states kept in', len(self.base or '') + self.size,
+             'bytes,', self.saves, 'saves at', avg_ms(self.save_time, self.saves), 'each,',
+             self.restores, 'restores at', avg_ms(self.restore_time, self.restores), 'each')
+
+class UndoState(object):
+    def __init__(self, env, store_var, pages, delta):
+        self.pages, self.delta = pages, delta
+        self.stack, self.fp, self.pc = tuple(env.stack), env.fp, env.pc
+        self.store_var = store_var
+        self.size = len(delta) + 8*len(self.stack)
+
+# the bytes of a xor b, a and b strings of the same length. done on
+# longs so the loop over the bytes runs in C
+def xor(a, b):
+    if not a:
+        return ''
+    return unhexlify('%0*x' % (2*len(a), int(hexlify(a), 16) ^ int(hexlify(b), 16)))
+
+# copies data (pages' bytes, end to end) into mem over those pages
+def put_pages(env, mem, pages, data):
+    i = 0
+    for page in pages:
+        start, end = env.page_range(page)
+        mem[start:end] = data[i:i+end-start]
+        i += end - start
@@ -351,3 +351,42 @@ def is_valid_getch_char(c):
 def is_valid_inline_char(c):
     # TODO: unicode input?
     return c in ['\n', '\t', '\r', '\b'] or (ord(c) > 31 and ord(c) < 127)
+
+# a screen with no terminal behind it: what's written is kept as text
+# in out, and input comes off the front of inputs (EOFError once it
+# runs out). for running an Env off screen, e.g. a clone (see Env.clone)
+class HeadlessScreen(object):
+    def __init__(self, env, inputs=()):
+        self.env = env
+        self.inputs = list(inputs)
+        self.out = []
+
+    def write(self, text):
+        self.out.append(text)
+    def msg(self, text):
+        self.out.append(text)
+
+    def get_line_of_input(self, prompt=''):
+        if not self.inputs:
+            raise EOFError('headless screen is out of input')
+        text = self.inputs.pop(0)
+        self.out.append(prompt + text + '\n')
+        return text
+    def getch(self):
+        if not self.inputs:
+            raise EOFError('headless screen is out of input')
+        return self.inputs.pop(0)[:1] or '\r'
+
+    # nothing to draw
+    def finish_wrapping(self):
+        pass
+    def flush(self):
+        pass
+    def first_draw(self):
+        pass
+    def blank_top_win(self):
+        pass
+    def blank_bottom_win(self):
+        pass
+    def scroll_top_line_only(self):
+        pass
@@ -1,17 +1,22 @@
 from __future__ import print_function
-from array import array
+from collections import deque
+import copy
 import sys
+import threading
+import weakref
 
 import ops
 import term
 import vterm
 import ops_decode
+import undo
 from zmath import to_signed_word, to_signed_char
-from debug import DBG, warn, err
+from debug import warn, err
 
 def b16_setter(base):
     def setter(self, val):
         val &= 0xffff
+        self.env.own_mem()
         self.env.mem[base] = val >> 8
         self.env.mem[base+1] = val & 0xff
     return setter
@@ -26,7 +31,9 @@ def s16_prop(base):
 
 def u8_prop(base):
     def getter(self): return self.env.u8(base)
-    def setter(self, val): self.env.mem[base] = val & 0xff
+    def setter(self, val):
+        self.env.own_mem()
+        self.env.mem[base] = val & 0xff
     return property(fget=getter, fset=setter)
 
 class Header(object):
@@ -112,9 +119,11 @@ def set_standard_flags(hdr):
     # menus (bit 8)
     # sound effects (bit 7)
     # mouse (bit 5)
-    # undo (bit 4)
     # and pictures (bit 3)
-    hdr.flags2 &= 0b1111111001000111
+    hdr.flags2 &= 0b1111111001010111
+    # undo (bit 4) too, if turned off
+    if not hdr.env.undo:
+        hdr.flags2 &= ~0b10000
 
     # use the apple 2e interp # to fix Beyond Zork compat
     hdr.interp_number = 2
@@ -144,27 +153,223 @@ def set_standard_flags(hdr):
     if hdr.hdr_ext_tab_length >= 4:
         env.mem[self.hdr_ext_tab_base+4] = 0
 
+# who needs to hear about writes to dyn mem. a cache calls
+# watch(start, end, callback) for each range it depends on, and from
+# then on callback(start, end) is called for any write landing on a
+# page of that range (the callback sorts out exact overlap itself).
+# pages counts the watches on each page, and a write only goes past
+# that count when it's nonzero, so writes nobody watches cost one
+# index and one test. everything that writes dyn mem tells env.watch:
+# write8/write16, the global var setters in ops_decode, and reset and
+# restore (as one write over all of dyn mem). only the interpreter's
+# own header field writes (see Header) go unannounced.
+# callbacks are kept as dict keys, so they need to hash, and the same
+# object has to go to watch and unwatch.
+class MemWatch(object):
+    PAGE_SHIFT = 8
+
+    def __init__(self, mem_len):
+        self.pages = [0] * ((mem_len >> self.PAGE_SHIFT) + 1)
+        self.callbacks = {} # page -> {callback: number of watches}
+
+    def page_range(self, start, end):
+        return xrange(start >> self.PAGE_SHIFT, ((end-1) >> self.PAGE_SHIFT) + 1)
+
+    def watch(self, start, end, callback):
+        for page in self.page_range(start, end):
+            callbacks = self.callbacks.setdefault(page, {})
+            callbacks[callback] = callbacks.get(callback, 0) + 1
+            self.pages[page] += 1
+
+    def unwatch(self, start, end, callback):
+        for page in self.page_range(start, end):
+            callbacks = self.callbacks[page]
+            callbacks[callback] -= 1
+            if not callbacks[callback]:
+                del callbacks[callback]
+            self.pages[page] -= 1
+
+    def notify(self, start, end):
+        to_call = set()
+        for page in self.page_range(start, end):
+            if self.pages[page]:
+                to_call.update(self.callbacks[page])
+        for callback in to_call:
+            callback(start, end)
+
+# decoded insts (see ops_decode.make_inst) by pc. a lookup that
+# misses decodes the inst and keeps it. with a limit set, the oldest
+# kept insts are evicted first. hits don't go through any python
+# code here (so they stay at dict speed); the run loops add to
+# lookups instead, and hits is lookups - misses.
+#
+# insts in dynamic mem are kept too, watched through env.watch and
+# with every byte they were decoded from listed in code_bytes, so a
+# write drops exactly the insts it touches. insts overlapping the
+# header aren't kept, since Header's fields are written unannounced.
+#
+# a clone's cache (see Env.clone) takes its static insts from the
+# cache it was cloned from, so each inst is decoded once for all of them.
+class InstCache(dict):
+    def __init__(self, env, limit=0):
+        dict.__init__(self)
+        self.env = env
+        self.static_mem_base = env.hdr.static_mem_base
+        self.limit = limit
+        self.shared = None # an InstCache to get static insts from
+        self.order = deque() # (pc, inst), oldest first, only kept with a limit
+        self.flushes = 0 # see predecode.py
+        self.flush_lock = threading.Lock()
+        self.code_bytes = {} # dyn mem addr -> pcs of kept insts using it
+        self.dyn_ends = {} # pc -> next_pc, for kept insts in dyn mem
+        self.lookups = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # what goes to env.watch (a bound method won't do as a key there,
+        # since it hashes like self, and dicts can't be hashed)
+        self.watcher = lambda start, end: self.mem_written(start, end)
+
+    def __missing__(self, pc):
+        self.misses += 1
+        if self.shared is not None and pc >= self.static_mem_base:
+            inst = self.shared[pc]
+        else:
+            inst = ops_decode.make_inst(self.env, pc)
+        if pc >= self.static_mem_base:
+            self.keep(pc, inst)
+        elif self.can_keep_dynamic(pc, inst.next_pc):
+            self.keep(pc, inst)
+            self.dyn_ends[pc] = inst.next_pc
+            for i in xrange(pc, inst.next_pc):
+                self.code_bytes.setdefault(i, []).append(pc)
+            self.env.watch.watch(pc, inst.next_pc, self.watcher)
+        return inst
+
+    def can_keep_dynamic(self, pc, next_pc):
+        return pc >= 0x40 and next_pc <= self.static_mem_base
+
+    def keep(self, pc, inst):
+        if self.limit:
+            while self.order and len(self.order) >= self.limit:
+                self.evict()
+            self.order.append((pc, inst))
+        self[pc] = inst
+
+    def evict(self):
+        pc, inst = self.order.popleft()
+        # pc may hold something newer by now (e.g. a compiled routine)
+        if self.get(pc) is inst:
+            if pc in self.dyn_ends:
+                self.forget_dynamic(pc)
+            else:
+                del self[pc]
+            self.evictions += 1
+
+    def forget_dynamic(self, pc):
+        del self[pc]
+        next_pc = self.dyn_ends.pop(pc)
+        for i in xrange(pc, next_pc):
+            pcs = self.code_bytes[i]
+            pcs.remove(pc)
+            if not pcs:
+                del self.code_bytes[i]
+        self.env.watch.unwatch(pc, next_pc, self.watcher)
+
+    # env.watch callback
+    def mem_written(self, start, end):
+        if end - start > len(self.code_bytes):
+            addrs = [addr for addr in self.code_bytes if start <= addr < end]
+        else:
+            addrs = xrange(start, end)
+        for addr in addrs:
+            for pc in list(self.code_bytes.get(addr, ())):
+                self.forget_dynamic(pc)
+                self.invalidations += 1
+
+    # for when all of dyn mem may have changed (restart, restore)
+    def drop_dynamic(self):
+        for pc in list(self.dyn_ends):
+            self.forget_dynamic(pc)
+
+    # for when the handlers changed (see tracing.py)
+    def flush(self):
+        with self.flush_lock:
+            self.flushes += 1
+            self.drop_dynamic()
+            self.clear()
+            self.order.clear()
+
+    def report(self):
+        warn('icache:', len(self), 'insts cached',
+             '(limit '+str(self.limit)+')' if self.limit else '(no limit)',
+             len(self.dyn_ends), 'from dynamic mem')
+        warn('   ', self.lookups - self.misses, 'hits,',
+             self.misses, 'misses,', self.evictions, 'evictions,',
+             self.invalidations, 'invalidated by writes')
+
 class Env:
     def __init__(self, mem):
         self.orig_mem = mem
-        self.mem = array('B', map(ord, mem))
+        self.mem = bytearray(mem)
+        self.mem_share = None # see own_mem()
 
         self.hdr = Header(self)
+
+        # copied out of hdr as plain ints for the write checks and var access
+        self.static_mem_base = self.hdr.static_mem_base
+        self.global_var_base = self.hdr.global_var_base
+        self.dyn_word_end = self.static_mem_base - 1 # past the last word wholly in dyn mem
+
+        self.watch = MemWatch(len(self.mem))
+        self.watched_pages = self.watch.pages
+
+        # which pages of dyn mem were written when: each write stamps its
+        # page with the current epoch. dirty_mark() starts a new epoch and
+        # returns the old one, and dirty_pages(mark) lists the pages written
+        # since, so save, undo, etc. each keep their own checkpoint.
+        self.epoch = 1
+        self.page_stamps = [0] * (((self.static_mem_base-1) >> 8) + 1) # MemWatch.PAGE_SHIFT
+        self.reset_mark = 0 # pages stamped past this may differ from the story file
+        self.turn_mark = 0
+        self.turns_counted = 0
+        self.turn_pages_total = 0
+        self.turn_pages_max = 0
+        self.page_hashes = None # see state_hash()
+        self.mem_hash = 0
+        self.hash_mark = 0
+        self.check_state_hash = False
+        self.icache = InstCache(self)
+        self.compiler = None # an ops_compile.RoutineCompiler, if turned on
+        self.accel = None # an accel.Accelerator, if turned on
+        self.memo = None # a memo.TurnMemo, if turned on
+        self.undo = undo.UndoRing() # None if turned off
+        self.rng_seeded = False # set by random_, for the memo
+        self.routine_headers = {} # see ops_impl.read_routine_header
+        self.untraced_state = None # set while tracing, see tracing.py
+        self.decoded_fields = None # pc -> ops_decode.decode_fields(), see decode_cache.py
+
+        self.screen_size = None
+        self.start_state(None)
+
+    # everything but mem that a restart puts back as it was. screen is
+    # kept if given, unless the header now says it's a different size
+    def start_state(self, screen):
+        old_size = self.screen_size
         set_standard_flags(self.hdr)
+        self.screen_size = self.hdr.screen_width_units, self.hdr.screen_height_units
 
         self.pc = self.hdr.pc
-        self.callstack = [ops.Frame(0)]
-        self.icache = {}
+        ops.set_frames(self, [ops.Frame(0)]) # sets self.stack, self.fp
+        self.last_inst = None # for run_pair_report
 
         self.fg_color = self.hdr.default_fg_color
         self.bg_color = self.hdr.default_bg_color
 
-        # to make quetzal saves easier
-        self.last_pc_branch_var = None
-        self.last_pc_store_var = None
-
+        if not screen or self.screen_size != old_size:
+            screen = vterm.Screen(self)
         self.output_buffer = {
-            1: vterm.Screen(self),
+            1: screen,
             2: '', # transcript
             3: '', # mem
             4: ''  # player input (not impld atm)
@@ -191,7 +396,8 @@ class Env:
         set_standard_flags(self.hdr)
 
     def u16(self, i):
-        return (self.mem[i] << 8) | self.mem[i+1]
+        mem = self.mem
+        return (mem[i] << 8) | mem[i+1]
     def s16(self, i):
         return to_signed_word(self.u16(i))
     def u8(self, i):
@@ -199,24 +405,179 @@ class Env:
     def s8(self, i):
         return to_signed_char(self.mem[i])
     def check_dyn_mem(self, i):
-        if i >= self.hdr.static_mem_base:
+        if i >= self.static_mem_base:
             err('game tried to write in static mem: '+str(i))
         if i <= 0x36 and i != 0x10:
             err('game tried to write in non-dyn header bytes: '+str(i))
+    # clones share mem (mem_share holds everyone still on it) until they
+    # write to it, and the first write takes a copy of its own. call
+    # before anything that writes into mem, and fetch self.mem after.
+    # compiled routines keep mem in a local, so they call it on the way in
+    def own_mem(self):
+        share = self.mem_share
+        if share is None:
+            return
+        self.mem_share = None
+        share.discard(self)
+        if share: # (if not, the rest have copies already)
+            self.mem = bytearray(self.mem)
+
     def write16(self, i, val):
-        self.check_dyn_mem(i)
-        self.mem[i] = (val >> 8) & 0xff
-        self.mem[i+1] = val & 0xff
+        if self.mem_share is not None:
+            self.own_mem()
+        if not 0x36 < i < self.dyn_word_end:
+            self.check_dyn_mem(i)
+            if i == self.dyn_word_end:
+                # the low byte lands in static mem, which has no page stamp
+                self.write8(i, val >> 8)
+                self.mem[i+1] = val & 0xff
+                return
+        mem = self.mem
+        mem[i] = (val >> 8) & 0xff
+        mem[i+1] = val & 0xff
+        page0, page1 = i >> 8, (i+1) >> 8 # MemWatch.PAGE_SHIFT
+        stamps = self.page_stamps
+        stamps[page0] = stamps[page1] = self.epoch
+        pages = self.watched_pages
+        if pages[page0] or pages[page1]:
+            self.watch.notify(i, i+2)
     def write8(self, i, val):
-        self.check_dyn_mem(i)
+        if self.mem_share is not None:
+            self.own_mem()
+        if not 0x36 < i < self.static_mem_base:
+            self.check_dyn_mem(i)
         self.mem[i] = val & 0xff
+        page = i >> 8 # MemWatch.PAGE_SHIFT
+        self.page_stamps[page] = self.epoch
+        if self.watched_pages[page]:
+            self.watch.notify(i, i+1)
+    # for when something rewrote all of dyn mem at once
+    def dyn_mem_replaced(self):
+        self.page_stamps[:] = [self.epoch] * len(self.page_stamps)
+        self.watch.notify(0, self.static_mem_base)
+    # or a range of it, straight into self.mem (see idioms.py)
+    def dyn_mem_written(self, start, end):
+        for page in self.watch.page_range(start, end):
+            self.page_stamps[page] = self.epoch
+        self.watch.notify(start, end)
+
+    def dirty_mark(self):
+        self.epoch += 1
+        return self.epoch - 1
+    def dirty_pages(self, mark):
+        return [page for page, stamp in enumerate(self.page_stamps) if stamp > mark]
+    def page_range(self, page):
+        start = page << 8 # MemWatch.PAGE_SHIFT
+        return start, min(start + 256, self.static_mem_base)
+
+    # called at each input op, for the pages-per-turn counts
+    def count_turn(self):
+        num_pages = len(self.dirty_pages(self.turn_mark))
+        self.turn_mark = self.dirty_mark()
+        self.turns_counted += 1
+        self.turn_pages_total += num_pages
+        self.turn_pages_max = max(self.turn_pages_max, num_pages)
+        if self.check_state_hash:
+            self.state_hash()
+    def dirty_report(self):
+        turns = self.turns_counted
+        warn('dirty pages:', len(self.page_stamps), 'pages of dyn mem,',
+             len(self.dirty_pages(self.reset_mark)), 'written since start/restart')
+        if turns:
+            warn('   ', '%.1f' % (float(self.turn_pages_total) / turns), 'written per turn on average,',
+                 self.turn_pages_max, 'at most, over', turns, 'turns')
+
+    # a fingerprint of the whole machine state: dyn mem, the stack and
+    # pc. each page of dyn mem keeps its own hash, mixed with the page
+    # number, and mem_hash is all of those xored together, so only the
+    # pages written since the last call get hashed again, each swapping
+    # its old hash out of mem_hash for the new one. with check_state_hash
+    # on, every page is hashed again anyway and compared.
+    def state_hash(self):
+        if self.page_hashes is None:
+            self.page_hashes = [self.hash_page(page) for page in xrange(len(self.page_stamps))]
+            self.mem_hash = 0
+            for page_hash in self.page_hashes:
+                self.mem_hash ^= page_hash
+        else:
+            for page in self.dirty_pages(self.hash_mark):
+                page_hash = self.hash_page(page)
+                self.mem_hash ^= self.page_hashes[page] ^ page_hash
+                self.page_hashes[page] = page_hash
+        self.hash_mark = self.dirty_mark()
+        if self.check_state_hash:
+            stale = [page for page, page_hash in enumerate(self.page_hashes)
+                     if self.hash_page(page) != page_hash]
+            if stale:
+                err('state hash missed writes to dyn mem pages: '+str(stale))
+        return hash((self.mem_hash, self.pc, self.fp, tuple(self.stack)))
+    def hash_page(self, page):
+        start, end = self.page_range(page)
+        return hash((page, str(self.mem[start:end])))
+
+    def get_frames(self):
+        return ops.get_frames(self)
+    def set_frames(self, frames):
+        ops.set_frames(self, frames)
     def reset(self):
         # only the bottom two bits of flags2 survive reset
         # (transcribe to printer & fixed pitch font)
         bits_to_save = self.hdr.flags2 & 3
-        self.__init__(self.orig_mem)
+        if self.memo:
+            self.memo.taint(self)
+        # static mem can't have changed, so only dyn mem goes back to the
+        # story file, and everything cached about static mem (the insts,
+        # routine headers, etc.) stays. the page stamps and epoch carry on
+        # too, so marks taken before the reset still work (and see every
+        # page as written)
+        base = self.static_mem_base
+        self.own_mem()
+        self.mem[:base] = self.orig_mem[:base]
+        self.start_state(self.screen)
+        self.icache.drop_dynamic()
+        self.dyn_mem_replaced()
+        self.reset_mark = self.turn_mark = self.dirty_mark()
         self.hdr.flags2 &= ~3
         self.hdr.flags2 |= bits_to_save
+
+    # another machine in the same state, to run separately. the story
+    # file and everything worked out from static mem (insts, routine
+    # headers, decoded fields, accel's natives) are shared; the stack
+    # and the screen/stream state are the clone's own, and so is mem
+    # once either side writes to it (see own_mem). screen is for the
+    # clone to write to, a vterm.HeadlessScreen if not given.
+    def clone(self, screen=None):
+        env = copy.copy(self)
+        # mem is a flat bytearray, so its static part can't be shared on
+        # its own, and copying by the page would put a lookup on every
+        # read. so the whole of it is shared, until the first write
+        if self.mem_share is None:
+            self.mem_share = weakref.WeakSet([self])
+        self.mem_share.add(env)
+        env.mem_share = self.mem_share
+        env.hdr = Header(env)
+        env.stack = list(self.stack)
+        env.watch = MemWatch(len(env.mem))
+        env.watched_pages = env.watch.pages
+        env.page_stamps = list(self.page_stamps)
+        if self.page_hashes is not None:
+            env.page_hashes = list(self.page_hashes)
+        env.icache = InstCache(env, self.icache.limit)
+        env.icache.shared = self.icache.shared or self.icache
+        # compiled routines get to the clone through the shared insts,
+        # but only the original compiles more (and records turns)
+        env.compiler = None
+        env.memo = None
+        env.last_inst = None
+        if self.undo:
+            env.undo = self.undo.clone()
+
+        env.cursor = dict(self.cursor)
+        env.selected_ostreams = set(self.selected_ostreams)
+        env.memory_ostream_stack = list(self.memory_ostream_stack)
+        env.output_buffer = dict(self.output_buffer)
+        env.output_buffer[1] = env.screen = screen or vterm.HeadlessScreen(env)
+        return env
     def quit(self):
         self.screen.flush()
         sys.exit()
@@ -224,63 +585,45 @@ class Env:
 def step(env):
 
     pc, icache = env.pc, env.icache
-    if pc in icache:
-        op, opinfo, env.pc = icache[pc]
-    else:
-        op, opinfo, env.pc = ops_decode.decode(env, pc)
-        if pc >= env.hdr.static_mem_base:
-            icache[pc] = op, opinfo, env.pc
+    inst = icache[pc]
+    icache.lookups += 1
+    op, opinfo, env.pc = inst.op, inst.opinfo, inst.next_pc
 
     if opinfo.has_dynamic_operands:
-        opinfo.fixup_dynamic_operands(env)
-
-    next_pc = env.pc
-
-    # for Quetzal
-    if opinfo.last_pc_branch_var:
-        env.last_pc_branch_var = opinfo.last_pc_branch_var
-    if opinfo.last_pc_store_var:
-        env.last_pc_store_var = opinfo.last_pc_store_var
-
-    if DBG:
-        warn(hex(pc))
-        warn('op:', op.__name__)
-        warn('    operands', dbg_decode_operands(env, op.__name__, opinfo.operands))
-        if opinfo.branch_offset != None:
-            warn('    branch_offset', opinfo.branch_offset)
-            warn('    branch_to', dbg_decode_branch(env, opinfo.branch_offset))
-            warn('    branch_on', opinfo.branch_on)
-
-        op(env, opinfo)
-
-        if opinfo.store_var:
-            warn(    'store_var', ops.get_var_name(opinfo.store_var))
-            warn(    'stored_result', dbg_decode_result(env, op.__name__, opinfo.store_var))
-    else:
-        op(env, opinfo)
-
-def dbg_decode_branch(env, offset):
-    if offset == 0 or offset == 1:
-        return env.callstack[-1].return_addr
-    return env.pc + offset - 2
-
-def dbg_decode_operands(env, opname, operands):
-    if opname in ['add', 'sub', 'mul', 'div', 'mod', 'jump', 'random_', 'print_num']:
-        return map(to_signed_word, operands)
-    elif opname in ['loadw', 'loadb', 'storew', 'storeb', 'inc_chk', 'dec_chk']:
-        return [operands[0], to_signed_word(operands[1])] + operands[2:]
-    elif opname in ['print_', 'print_ret']:
-        result = ops.unpack_string(env, operands)
-        if len(result) > 40:
-            return repr(result[:40] + '...')
-        return result
-    return operands
-
-def dbg_decode_result(env, opname, store_var):
-    if 'call' in opname:
-        return 'unknown (just called)'
-    var = ops.get_var(env, store_var, pop_stack=False)
-    if opname in ['add', 'sub', 'mul', 'div', 'mod']:
-        return to_signed_word(var)
-    return var
-
+        opinfo.operands = opinfo.fetch_operands(env)
+
+    op(env, opinfo)
+
+# the threaded engine: same icache as step(), but each cached
+# inst does its own work and hands back the next pc, so the loop
+# here is just a cache probe and a call. runs at most budget insts.
+def run(env, budget):
+    icache = env.icache
+    pc = env.pc
+    for i in xrange(budget):
+        pc = icache[pc](env)
+    env.pc = pc
+    icache.lookups += budget
+
+# report mode: run() without superinstructions (see ops_decode.FUSE),
+# counting how often each op follows another. keys are
+# (first op name, second op name, 'next' or 'branch').
+def run_pair_report(env, budget, pair_counts):
+    icache = env.icache
+    pc, prev = env.pc, env.last_inst
+    for i in xrange(budget):
+        inst = icache[pc]
+        if prev:
+            where = 'next' if pc == prev.next_pc else 'branch'
+            key = prev.op.__name__, inst.op.__name__, where
+            pair_counts[key] = pair_counts.get(key, 0) + 1
+        prev = inst
+        pc = inst(env)
+    env.pc, env.last_inst = pc, prev
+    icache.lookups += budget
+
+def print_pair_report(pair_counts, top_n):
+    pairs = sorted(pair_counts.items(), key=lambda item: -item[1])
+    warn('top', top_n, 'of', len(pairs), 'op pairs seen:')
+    for (first, second, where), count in pairs[:top_n]:
+        warn('   ', str(count).rjust(10), first, '->', second, '('+where+')')